@@ -0,0 +1,233 @@
+import asyncio
+import hashlib
+import itertools
+import json
+import time
+from urllib.parse import parse_qs
+
+
+class FakeHTTPServer:
+    """Minimal keep-alive HTTP/1.1 server on localhost for the benchmark stand-ins"""
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.port = None
+        self.requests = 0
+        self._server = None
+        self._connections = set()
+
+    @property
+    def url(self) -> str:
+        return f'http://127.0.0.1:{self.port}'
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle_connection, '127.0.0.1', 0)
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            for task in list(self._connections):
+                task.cancel()
+            await self._server.wait_closed()
+
+    async def _handle_connection(self, reader, writer):
+        task = asyncio.current_task()
+        self._connections.add(task)
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, path, _ = request_line.decode().split(' ', 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode().partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get('content-length', 0)))
+                self.requests += 1
+                if self.latency:
+                    await asyncio.sleep(self.latency)
+                await self.handle_request(method, path, headers, body, writer)
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.CancelledError):
+            pass
+        finally:
+            self._connections.discard(task)
+            writer.close()
+
+    async def handle_request(self, method: str, path: str, headers: dict, body: bytes, writer):
+        raise NotImplementedError
+
+    @staticmethod
+    async def respond(writer, data, status: str = '200 OK', content_type: str = 'application/json'):
+        payload = data if isinstance(data, bytes) else json.dumps(data).encode()
+        writer.write(
+            f'HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\nContent-Length: {len(payload)}\r\n\r\n'.encode()
+            + payload
+        )
+        await writer.drain()
+
+    @staticmethod
+    async def respond_stream(writer, chunks, content_type: str = 'text/event-stream'):
+        writer.write(f'HTTP/1.1 200 OK\r\nContent-Type: {content_type}\r\nTransfer-Encoding: chunked\r\n\r\n'.encode())
+        async for chunk in chunks:
+            writer.write(f'{len(chunk):x}\r\n'.encode() + chunk + b'\r\n')
+            await writer.drain()
+        writer.write(b'0\r\n\r\n')
+        await writer.drain()
+
+
+class FakeTelegramServer(FakeHTTPServer):
+    """Stand-in for the Bot API, answers every method the bot uses with a plausible result"""
+
+    BOT_USER = {"id": 1, "is_bot": True, "first_name": "bench_bot", "username": "bench_bot"}
+
+    def __init__(self, latency: float = 0.0):
+        super().__init__(latency)
+        self._message_ids = itertools.count(1_000_000)
+        self.calls = {}
+
+    @property
+    def base_url(self) -> str:
+        return f'{self.url}/bot'
+
+    @property
+    def base_file_url(self) -> str:
+        return f'{self.url}/file/bot'
+
+    async def handle_request(self, method: str, path: str, headers: dict, body: bytes, writer):
+        if path.startswith('/file/'):
+            return await self.respond(writer, b'OggS' + bytes(1024), content_type='audio/ogg')
+        api_method = path.rsplit('/', 1)[-1]
+        self.calls[api_method] = self.calls.get(api_method, 0) + 1
+        params = self._parse_params(headers, body)
+        result = self._result(api_method, params)
+        await self.respond(writer, {"ok": True, "result": result})
+
+    @staticmethod
+    def _parse_params(headers: dict, body: bytes) -> dict:
+        content_type = headers.get('content-type', '')
+        if content_type.startswith('application/json'):
+            return json.loads(body or b'{}')
+        if content_type.startswith('application/x-www-form-urlencoded'):
+            return {key: values[0] for key, values in parse_qs(body.decode()).items()}
+        return {}
+
+    def _result(self, api_method: str, params: dict):
+        if api_method == 'getMe':
+            return self.BOT_USER
+        if api_method == 'getFile':
+            return {"file_id": params.get('file_id', 'file'), "file_unique_id": "unique", "file_size": 1024, "file_path": "voice/file.oga"}
+        if api_method in ('deleteWebhook', 'setWebhook', 'setMyCommands', 'sendChatAction', 'deleteMessage'):
+            return True
+        if api_method == 'getUpdates':
+            return []
+        chat_id = int(params.get('chat_id', 0) or 0)
+        message = {
+            "message_id": int(params.get('message_id', 0) or 0) or next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private" if chat_id > 0 else "group", "title": "bench"},
+            "from": self.BOT_USER,
+        }
+        if 'text' in params:
+            message["text"] = params['text']
+        if api_method == 'sendPhoto':
+            message["photo"] = [{"file_id": f"photo{message['message_id']}", "file_unique_id": "p", "width": 1024, "height": 1024}]
+        if api_method == 'sendVoice':
+            message["voice"] = {"file_id": f"voice{message['message_id']}", "file_unique_id": "v", "duration": 1}
+        return message
+
+
+class FakeOpenAIServer(FakeHTTPServer):
+    """AsyncOpenAI compatible stand-in with configurable latency, streaming and answer length.
+
+    Prompt caching is simulated per message: the longest run of leading messages seen in an
+    earlier request is reported as cached_tokens once it reaches PROMPT_CACHE_MIN_TOKENS.
+    """
+
+    PROMPT_CACHE_MIN_TOKENS = 1024
+
+    def __init__(self, latency: float = 0.0, chunk_delay: float = 0.0, response_words: int = 50):
+        super().__init__(latency)
+        self.chunk_delay = chunk_delay
+        self.response_words = response_words
+        self._prefixes = set()
+
+    @property
+    def base_url(self) -> str:
+        return f'{self.url}/v1'
+
+    async def handle_request(self, method: str, path: str, headers: dict, body: bytes, writer):
+        if path.endswith('/chat/completions'):
+            request = json.loads(body)
+            if request.get('stream'):
+                return await self.respond_stream(writer, self._completion_chunks(request))
+            return await self.respond(writer, self._completion(request))
+        if path.endswith('/images/generations'):
+            return await self.respond(writer, {"created": int(time.time()), "data": [{"url": "http://127.0.0.1/image.png"}]})
+        if path.endswith('/audio/speech'):
+            return await self.respond(writer, b'OggS' + bytes(4096), content_type='audio/ogg')
+        if path.endswith('/audio/transcriptions'):
+            return await self.respond(writer, {"text": "benchmark voice message"})
+        await self.respond(writer, {"error": {"message": f"unknown path {path}"}}, status='404 Not Found')
+
+    def _words(self) -> list:
+        return [f"word{i % 97} " for i in range(self.response_words)]
+
+    def _usage(self, request: dict) -> dict:
+        prefix = hashlib.sha256()
+        prompt_tokens = 0
+        cached_tokens = 0
+        for message in request.get('messages', []):
+            prefix.update(json.dumps(message, sort_keys=True).encode())
+            prompt_tokens += len(str(message.get('content', '')).split())
+            digest = prefix.hexdigest()
+            if digest in self._prefixes:
+                cached_tokens = prompt_tokens
+            self._prefixes.add(digest)
+        if cached_tokens < self.PROMPT_CACHE_MIN_TOKENS:
+            cached_tokens = 0
+        return {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": self.response_words,
+            "total_tokens": prompt_tokens + self.response_words,
+            "prompt_tokens_details": {"cached_tokens": cached_tokens},
+        }
+
+    def _completion(self, request: dict) -> dict:
+        content = ''.join(self._words())
+        return {
+            "id": "chatcmpl-bench",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": request.get('model', 'bench'),
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+            "usage": self._usage(request),
+        }
+
+    async def _completion_chunks(self, request: dict):
+        for word in self._words():
+            if self.chunk_delay:
+                await asyncio.sleep(self.chunk_delay)
+            chunk = {
+                "id": "chatcmpl-bench",
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": request.get('model', 'bench'),
+                "choices": [{"index": 0, "delta": {"content": word}, "finish_reason": None}],
+            }
+            yield f'data: {json.dumps(chunk)}\n\n'.encode()
+        if (request.get('stream_options') or {}).get('include_usage'):
+            chunk = {
+                "id": "chatcmpl-bench",
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": request.get('model', 'bench'),
+                "choices": [],
+                "usage": self._usage(request),
+            }
+            yield f'data: {json.dumps(chunk)}\n\n'.encode()
+        yield b'data: [DONE]\n\n'
@@ -0,0 +1,211 @@
+"""Offline load test of the bot handlers against fake Telegram and OpenAI servers.
+
+Every simulated user sends its messages one after another (waiting for the reply),
+users run concurrently. Reports handler latency percentiles per update kind,
+throughput, event-loop lag and peak RSS for each (users, history length) pair.
+
+    python benchmarks/run.py --users 1 10 50 --history 0 100 --messages 10 --stream
+"""
+import argparse
+import asyncio
+import itertools
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from telegram import Update
+from telegram.ext import Application
+
+from fake_servers import FakeOpenAIServer, FakeTelegramServer
+from lib.ai import OpenAI
+from lib.configuration import YamlConfiguration
+from lib.history_backends import create_history_backend
+from lib.metrics import LoopLagMonitor, MetricsRegistry
+from lib.telegram import TelegramBot
+
+BOT_TOKEN = '123456:BENCHMARK'
+CONFIG_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src', 'config.yaml')
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config', type=str, default=CONFIG_PATH)
+    parser.add_argument('--users', type=int, nargs='+', default=[1, 10, 50])
+    parser.add_argument('--history', type=int, nargs='+', default=[0, 100])
+    parser.add_argument('--messages', type=int, default=10, help='messages sent by every user')
+    parser.add_argument('--group-ratio', type=float, default=0.2)
+    parser.add_argument('--command-ratio', type=float, default=0.1)
+    parser.add_argument('--openai-latency', type=float, default=0.05)
+    parser.add_argument('--telegram-latency', type=float, default=0.005)
+    parser.add_argument('--chunk-delay', type=float, default=0.0)
+    parser.add_argument('--response-words', type=int, default=50)
+    parser.add_argument('--stream', action='store_true')
+    parser.add_argument('--history-backend', type=str, default=None)
+    parser.add_argument('--send-rate', type=float, default=1e6,
+                        help='global, chat and group send rate limit, the default leaves sending unthrottled to measure the bot itself')
+    parser.add_argument('--seed', type=int, default=1)
+    return parser.parse_args()
+
+
+def percentile(values: list, fraction: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def peak_rss_mb() -> float:
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class UpdateFactory:
+
+    GROUP_CHAT_ID = -100500
+    GROUP_TEXT = 'валерка, что нового в мире?'
+
+    def __init__(self, bot, rng: random.Random, group_ratio: float, command_ratio: float):
+        self._bot = bot
+        self._rng = rng
+        self._group_ratio = group_ratio
+        self._command_ratio = command_ratio
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+
+    def next_update(self, user_id: int) -> tuple:
+        roll = self._rng.random()
+        if roll < self._command_ratio:
+            command = self._rng.choice(['/info', '/help'])
+            return command, self._build(user_id, user_id, 'private', command, command=True)
+        if roll < self._command_ratio + self._group_ratio:
+            return 'group', self._build(user_id, self.GROUP_CHAT_ID, 'group', self.GROUP_TEXT)
+        return 'private', self._build(user_id, user_id, 'private', f'сообщение {next(self._message_ids)} от пользователя {user_id}')
+
+    def _build(self, user_id: int, chat_id: int, chat_type: str, text: str, command=False) -> Update:
+        message = {
+            "message_id": next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": chat_type, "title": "bench" if chat_type != 'private' else None},
+            "from": {"id": user_id, "is_bot": False, "first_name": f"user{user_id}", "username": f"user{user_id}"},
+            "text": text,
+        }
+        if command:
+            message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text)}]
+        return Update.de_json({"update_id": next(self._update_ids), "message": message}, self._bot)
+
+
+def seed_histories(config, users: int, history_length: int):
+    backend = create_history_backend(config.telegram_settings)
+    for user_id in range(1, users + 1):
+        storage = [
+            {"role": "user" if i % 2 == 0 else "assistant", "content": f"старое сообщение {i} " * 8}
+            for i in range(history_length)
+        ]
+        backend.replace(user_id, f'user{user_id}', storage)
+    backend.close()
+
+
+async def run_scenario(args, users: int, history_length: int) -> dict:
+    telegram_server = FakeTelegramServer(latency=args.telegram_latency)
+    openai_server = FakeOpenAIServer(latency=args.openai_latency, chunk_delay=args.chunk_delay, response_words=args.response_words)
+    await telegram_server.start()
+    await openai_server.start()
+    logs_dir = tempfile.mkdtemp(prefix='bot_bench_')
+    try:
+        config = YamlConfiguration(args.config, os.path.dirname(args.config)).load()
+        config.telegram_settings.logs_dir = logs_dir
+        config.telegram_settings.stream_responses = args.stream
+        config.telegram_settings.white_lists_persons = None
+        config.telegram_settings.black_lists_persons = None
+        config.telegram_settings.white_lists_groups = None
+        config.telegram_settings.black_lists_groups = None
+        if args.history_backend:
+            config.telegram_settings.history_backend = args.history_backend
+        config.telegram_settings.send_global_rate = args.send_rate
+        config.telegram_settings.send_chat_rate = args.send_rate
+        config.telegram_settings.send_group_rate = args.send_rate
+        config.ai_settings.api_base_url = openai_server.base_url
+        seed_histories(config, users, history_length)
+
+        open_ai = OpenAI(api_key='benchmark', configuration=config.ai_settings)
+        telegram_bot = TelegramBot(token=BOT_TOKEN, configuration=config.telegram_settings)
+        telegram_bot.set_ai_handler(open_ai)
+        open_ai.warm_up()
+        builder = Application.builder().base_url(telegram_server.base_url).base_file_url(telegram_server.base_file_url)
+        application = telegram_bot.build_application(builder)
+        await application.initialize()
+        await application.post_init(application)
+
+        factory = UpdateFactory(application.bot, random.Random(args.seed), args.group_ratio, args.command_ratio)
+        latencies = {}
+        lag_samples = []
+        # a registry of its own, so every run measures only its own lag and finer than the bot's monitor
+        lag_monitor = LoopLagMonitor(MetricsRegistry(), interval=0.01, samples=lag_samples)
+
+        async def user_session(user_id: int):
+            for _ in range(args.messages):
+                kind, update = factory.next_update(user_id)
+                started = time.perf_counter()
+                await application.update_processor.process_update(update, application.process_update(update))
+                latencies.setdefault(kind, []).append(time.perf_counter() - started)
+
+        lag_monitor.start()
+        started = time.perf_counter()
+        await asyncio.gather(*(user_session(user_id) for user_id in range(1, users + 1)))
+        elapsed = time.perf_counter() - started
+        await lag_monitor.stop()
+
+        prompt_cache = open_ai.get_prompt_cache_stats()
+        await application.post_shutdown(application)
+        await application.shutdown()
+    finally:
+        await telegram_server.stop()
+        await openai_server.stop()
+        shutil.rmtree(logs_dir, ignore_errors=True)
+
+    total = sum(len(values) for values in latencies.values())
+    return {
+        "users": users,
+        "history": history_length,
+        "latencies": latencies,
+        "messages_per_sec": total / elapsed if elapsed else 0.0,
+        "loop_lag_p99": percentile(lag_samples, 0.99),
+        "loop_lag_max": max(lag_samples, default=0.0),
+        "telegram_calls": dict(telegram_server.calls),
+        "openai_requests": openai_server.requests,
+        "prompt_cache_hit_ratio": prompt_cache["hit_ratio"],
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+def print_result(result: dict):
+    print(f"\n== users={result['users']} history={result['history']} ==")
+    print(f"throughput: {result['messages_per_sec']:.1f} msg/s, "
+          f"loop lag p99: {result['loop_lag_p99'] * 1000:.1f} ms (max {result['loop_lag_max'] * 1000:.1f} ms), "
+          f"peak RSS: {result['peak_rss_mb']:.1f} MB, openai requests: {result['openai_requests']}, "
+          f"prompt cache hits: {result['prompt_cache_hit_ratio'] * 100:.0f}%")
+    print(f"{'handler':<10}{'count':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for kind, values in sorted(result['latencies'].items()):
+        print(f"{kind:<10}{len(values):>8}"
+              f"{percentile(values, 0.5) * 1000:>10.1f}"
+              f"{percentile(values, 0.95) * 1000:>10.1f}"
+              f"{percentile(values, 0.99) * 1000:>10.1f}")
+
+
+async def main():
+    args = parse_args()
+    os.environ.setdefault('openai_api_key', 'benchmark')
+    for users in args.users:
+        for history_length in args.history:
+            print_result(await run_scenario(args, users, history_length))
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
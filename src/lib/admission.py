@@ -0,0 +1,201 @@
+import asyncio
+import contextlib
+import json
+import os
+import time
+from collections import deque
+
+from .errors import AdmissionException
+
+
+class SlidingWindowBudget:
+    """Requests and tokens spent by one user or chat during the last window seconds"""
+
+    def __init__(self, window: float):
+        self._window = window
+        self._events = deque()
+        self.tokens = 0
+
+    def _expire(self, now: float):
+        while self._events and self._events[0][0] <= now - self._window:
+            _, tokens = self._events.popleft()
+            self.tokens -= tokens
+
+    def usage(self, now: float) -> tuple:
+        self._expire(now)
+        return len(self._events), self.tokens
+
+    def retry_after(self, now: float) -> float:
+        if not self._events:
+            return 0.0
+        return max(0.0, self._events[0][0] + self._window - now)
+
+    def add(self, now: float, tokens: int, request=True):
+        if request or not self._events:
+            self._events.append([now, tokens])
+        else:
+            # tokens of a completion belong to the request that produced it
+            self._events[-1][1] += tokens
+        self.tokens += tokens
+
+    def dump(self) -> list:
+        return [list(event) for event in self._events]
+
+    def load(self, events: list, now: float):
+        self._events = deque([float(ts), int(tokens)] for ts, tokens in events)
+        self.tokens = sum(tokens for _, tokens in self._events)
+        self._expire(now)
+
+
+class AdmissionController:
+    """Per-user and per-chat budgets plus a bounded wait queue in front of the LLM calls.
+
+    A request over its sliding window budget is rejected right away. Admitted requests wait
+    for one of max_concurrent slots; when queue_size requests already wait, or a slot is not
+    free within queue_timeout seconds, the request is shed. Budgets are saved to state_file
+    so they survive restarts.
+    """
+
+    DEFAULT_WINDOW = 3600
+    DEFAULT_MAX_CONCURRENT = 16
+    DEFAULT_QUEUE_SIZE = 64
+    DEFAULT_QUEUE_TIMEOUT = 30
+    SAVE_INTERVAL = 30
+
+    def __init__(self, configuration, state_file: str = None):
+        self._window = getattr(configuration, 'budget_window', None) or self.DEFAULT_WINDOW
+        self._user_requests = getattr(configuration, 'user_requests_per_window', None)
+        self._user_tokens = getattr(configuration, 'user_tokens_per_window', None)
+        self._chat_requests = getattr(configuration, 'chat_requests_per_window', None)
+        self._chat_tokens = getattr(configuration, 'chat_tokens_per_window', None)
+        self._max_concurrent = getattr(configuration, 'admission_max_concurrent', None) or self.DEFAULT_MAX_CONCURRENT
+        self._queue_size = getattr(configuration, 'admission_queue_size', None) or self.DEFAULT_QUEUE_SIZE
+        self._queue_timeout = getattr(configuration, 'admission_queue_timeout', None) or self.DEFAULT_QUEUE_TIMEOUT
+        self._state_file = state_file
+        self._slots = asyncio.Semaphore(self._max_concurrent)
+        self._waiting = 0
+        self._budgets = {}
+        self._changed = False
+        self._save_task = None
+        self.admitted = 0
+        self.rejected = 0
+        self.shed = 0
+
+    def _budget(self, key: str) -> SlidingWindowBudget:
+        budget = self._budgets.get(key)
+        if budget is None:
+            budget = SlidingWindowBudget(self._window)
+            self._budgets[key] = budget
+        return budget
+
+    def _check(self, key: str, max_requests, max_tokens, tokens: int, now: float):
+        if key not in self._budgets:
+            return
+        budget = self._budgets[key]
+        requests, used_tokens = budget.usage(now)
+        if (max_requests and requests >= max_requests) or (max_tokens and used_tokens + tokens > max_tokens):
+            self.rejected += 1
+            raise AdmissionException("budget", budget.retry_after(now))
+
+    @contextlib.asynccontextmanager
+    async def admit(self, user_id: int, chat_id: int, prompt_tokens: int = 0):
+        """Hold a slot for one LLM request, raises AdmissionException if it can not be served"""
+        now = time.time()
+        user_key, chat_key = f'user:{user_id}', f'chat:{chat_id}'
+        self._check(user_key, self._user_requests, self._user_tokens, prompt_tokens, now)
+        if chat_id != user_id:
+            self._check(chat_key, self._chat_requests, self._chat_tokens, prompt_tokens, now)
+        if self._slots.locked() and self._waiting >= self._queue_size:
+            self.shed += 1
+            raise AdmissionException("busy")
+        self._waiting += 1
+        try:
+            await asyncio.wait_for(self._slots.acquire(), self._queue_timeout)
+        except asyncio.TimeoutError:
+            self.shed += 1
+            raise AdmissionException("busy")
+        finally:
+            self._waiting -= 1
+        try:
+            self._budget(user_key).add(now, prompt_tokens)
+            if chat_id != user_id:
+                self._budget(chat_key).add(now, prompt_tokens)
+            self._changed = True
+            self.admitted += 1
+            yield
+        finally:
+            self._slots.release()
+
+    def add_tokens(self, user_id: int, chat_id: int, tokens: int):
+        """Charge completion tokens to the last request of the user and the chat"""
+        now = time.time()
+        self._budget(f'user:{user_id}').add(now, tokens, request=False)
+        if chat_id != user_id:
+            self._budget(f'chat:{chat_id}').add(now, tokens, request=False)
+        self._changed = True
+
+    def stats(self) -> dict:
+        return {
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "shed": self.shed,
+            "waiting": self._waiting,
+            "tracked_keys": len(self._budgets),
+        }
+
+    async def start(self):
+        if self._state_file:
+            await asyncio.to_thread(self._load)
+            self._save_task = asyncio.create_task(self._save_loop())
+
+    async def stop(self):
+        if self._save_task is not None:
+            self._save_task.cancel()
+            try:
+                await self._save_task
+            except asyncio.CancelledError:
+                pass
+            self._save_task = None
+        await self.save()
+
+    async def _save_loop(self):
+        while True:
+            await asyncio.sleep(self.SAVE_INTERVAL)
+            try:
+                await self.save()
+            except Exception as e:
+                print("Error saving admission budgets: ", e)
+
+    async def save(self):
+        if not self._state_file or not self._changed:
+            return
+        now = time.time()
+        state = {}
+        for key, budget in list(self._budgets.items()):
+            budget.usage(now)
+            events = budget.dump()
+            if events:
+                state[key] = events
+            else:
+                del self._budgets[key]
+        self._changed = False
+        await asyncio.to_thread(self._write, state)
+
+    def _write(self, state: dict):
+        tmp_path = self._state_file + '.tmp'
+        with open(tmp_path, 'w') as file:
+            json.dump(state, file)
+        os.replace(tmp_path, self._state_file)
+
+    def _load(self):
+        try:
+            with open(self._state_file, 'r') as file:
+                state = json.load(file)
+        except FileNotFoundError:
+            return
+        except json.JSONDecodeError as e:
+            print("Error loading admission budgets: ", e)
+            return
+        now = time.time()
+        for key, events in state.items():
+            self._budget(key).load(events, now)
@@ -1,28 +1,259 @@
+import asyncio
+import hashlib
 import io
+import json
 import math
 import os
+import threading
+import time
+from collections import OrderedDict
 from io import BytesIO
-from typing import Tuple
+from typing import AsyncIterator, Awaitable, Callable, Tuple
 
-import tiktoken
-import openai
-from openai import AsyncOpenAI
 
+from .ai_client import ResilientOpenAIClient, create_async_client
 from .errors import OpenAIException
+from .images import VISION_MAX_SIDE, VISION_SHORT_SIDE, count_vision_tokens
+from .metrics import REGISTRY
+
+
+TOKENS_USED = REGISTRY.counter('openai_tokens_total', 'Tokens reported in completion usage', ('model', 'kind'))
+PROMPT_CACHED = REGISTRY.histogram(
+    'openai_prompt_cached_ratio', 'Share of the prompt tokens of a request served from the provider prompt cache',
+    buckets=(0, 0.25, 0.5, 0.75, 0.9, 1),
+)
+COALESCED = REGISTRY.counter('openai_coalesced_requests_total', 'Requests served by another identical call', ('endpoint',))
+
+
+class ResponseCache:
+    """Content-addressed cache for API results.
+
+    Keys are hashes of (endpoint, model, params, normalized input). Values live in a
+    size-bounded LRU with a TTL, audio bytes and Telegram file_ids can also be kept in
+    an optional on-disk tier so repeats survive restarts.
+    """
+
+    def __init__(self, max_entries: int = 512, ttl: float = 3600, disk_dir: str = None, disk_max_entries: int = 2048):
+        self._max_entries = max_entries
+        self._ttl = ttl
+        self._entries = OrderedDict()
+        self._disk_dir = disk_dir
+        self._disk_max_entries = disk_max_entries
+        self._disk_index = OrderedDict()
+        self._disk_lock = threading.Lock()
+        if disk_dir:
+            os.makedirs(disk_dir, exist_ok=True)
+            files = [f for f in os.listdir(disk_dir) if not f.endswith('.tmp')]
+            for filename in sorted(files, key=lambda f: os.path.getmtime(os.path.join(disk_dir, f))):
+                self._disk_index[filename] = True
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def normalize(text: str) -> str:
+        return " ".join(text.split()).casefold()
+
+    @classmethod
+    def make_key(cls, endpoint: str, model: str, params: dict, data) -> str:
+        if isinstance(data, str):
+            data = cls.normalize(data)
+        raw = json.dumps([endpoint, model, params, data], sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(raw.encode()).hexdigest()
+
+    def get(self, key: str):
+        entry = self._entries.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def set(self, key: str, value, ttl: float = None):
+        ttl = self._ttl if ttl is None else min(ttl, self._ttl)
+        self._entries[key] = (time.monotonic() + ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self._max_entries:
+            self._entries.popitem(last=False)
+
+    async def get_bytes(self, key: str) -> bytes | None:
+        value = self.get(key)
+        if value is not None or not self._disk_dir:
+            return value
+        data = await asyncio.to_thread(self._read_disk, f'{key}.bin')
+        if data is None:
+            return None
+        self.misses -= 1
+        self.hits += 1
+        self.set(key, data)
+        return data
+
+    async def set_bytes(self, key: str, data: bytes):
+        self.set(key, data)
+        if self._disk_dir:
+            await asyncio.to_thread(self._write_disk, f'{key}.bin', data)
+
+    async def get_file_id(self, key: str) -> str | None:
+        """Telegram file_id of an already sent result, so it can be re-sent without uploading"""
+        file_key = key + ':file_id'
+        value = self.get(file_key)
+        if value is not None or not self._disk_dir:
+            return value
+        data = await asyncio.to_thread(self._read_disk, f'{key}.file_id')
+        if data is None:
+            return None
+        self.misses -= 1
+        self.hits += 1
+        value = data.decode()
+        self.set(file_key, value)
+        return value
+
+    async def set_file_id(self, key: str, file_id: str):
+        self.set(key + ':file_id', file_id)
+        if self._disk_dir:
+            await asyncio.to_thread(self._write_disk, f'{key}.file_id', file_id.encode())
+
+    def _read_disk(self, filename: str) -> bytes | None:
+        path = os.path.join(self._disk_dir, filename)
+        try:
+            if os.path.getmtime(path) + self._ttl < time.time():
+                os.remove(path)
+                with self._disk_lock:
+                    self._disk_index.pop(filename, None)
+                return None
+            with open(path, 'rb') as file:
+                return file.read()
+        except FileNotFoundError:
+            return None
+
+    def _write_disk(self, filename: str, data: bytes):
+        path = os.path.join(self._disk_dir, filename)
+        with open(path + '.tmp', 'wb') as file:
+            file.write(data)
+        os.replace(path + '.tmp', path)
+        with self._disk_lock:
+            self._disk_index[filename] = True
+            self._disk_index.move_to_end(filename)
+            evicted = []
+            while len(self._disk_index) > self._disk_max_entries:
+                evicted.append(self._disk_index.popitem(last=False)[0])
+        for old_filename in evicted:
+            try:
+                os.remove(os.path.join(self._disk_dir, old_filename))
+            except FileNotFoundError:
+                pass
+
+    def stats(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses, "entries": len(self._entries), "disk_entries": len(self._disk_index)}
+
+
+class SingleFlight:
+    """Shares one upstream call between identical concurrent requests.
+
+    A request whose key matches a call in flight waits for that call instead of starting
+    its own, a successful result is also handed out for window seconds after it arrived.
+    Failures are shared with the requests already waiting but never kept.
+    """
+
+    def __init__(self, window: float = 0):
+        self._window = window
+        self._flights = {}
+        self.calls = 0
+        self.coalesced = 0
+
+    def join(self, key: str, endpoint: str = '') -> asyncio.Future | None:
+        flight = self._flights.get(key)
+        if flight is not None:
+            self.coalesced += 1
+            COALESCED.inc(endpoint=endpoint)
+        return flight
+
+    def start(self, key: str) -> asyncio.Future:
+        flight = asyncio.get_running_loop().create_future()
+        self._flights[key] = flight
+        self.calls += 1
+        return flight
+
+    def finish(self, key: str, flight: asyncio.Future, result=None, error: BaseException = None):
+        if error is None:
+            flight.set_result(result)
+            if self._window:
+                asyncio.get_running_loop().call_later(self._window, self._forget, key, flight)
+                return
+        else:
+            if not isinstance(error, Exception):
+                # the leader was cancelled or closed, the requests waiting for it still get an answer
+                error = OpenAIException("Запрос прерван, попробуйте еще раз")
+            flight.set_exception(error)
+            # retrieved here so a flight nobody joined does not log "exception was never retrieved"
+            flight.exception()
+        self._forget(key, flight)
+
+    def _forget(self, key: str, flight: asyncio.Future):
+        if self._flights.get(key) is flight:
+            del self._flights[key]
+
+    async def do(self, key: str, call: Callable[[], Awaitable], endpoint: str = ''):
+        """Return the result of call(), or of the identical call already in flight"""
+        flight = self.join(key, endpoint)
+        if flight is not None:
+            return await asyncio.shield(flight)
+        flight = self.start(key)
+        try:
+            result = await call()
+        except BaseException as e:
+            self.finish(key, flight, error=e)
+            raise
+        self.finish(key, flight, result=result)
+        return result
+
+    def stats(self) -> dict:
+        return {"calls": self.calls, "coalesced": self.coalesced, "in_flight": len(self._flights)}
+
+
+class ApproximateEncoding:
+    """Stand-in for the tiktoken encoding when its file can not be loaded, about 4 bytes of UTF-8 per token"""
+
+    name = 'approximate'
+
+    def encode(self, text: str) -> range:
+        return range((len(text.encode()) + 3) // 4)
+
+
+def load_encoding(model: str):
+    """tiktoken encoding of model, or ApproximateEncoding when its file can not be loaded"""
+    # imported on first use, tiktoken is not needed by processes that never count tokens
+    import tiktoken
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        raise ValueError(f"Model {model} not recognised")
+    except Exception as e:
+        print(f"Error loading tiktoken encoding for {model}, token counts are estimated: ", e)
+        return ApproximateEncoding()
 
 
 class OpenAI:
 
+    # generated image urls expire after an hour
+    IMAGE_URL_TTL = 3000
+    SPEECH_CHUNK_SIZE = 16384
+
     def __init__(self, api_key=None, configuration=None):
         if not api_key:
             api_key = os.environ.get("openai_api_key", None)
         if not api_key:
             raise ValueError("OpenAI API key is not defined")
-        self.client = AsyncOpenAI(api_key=api_key)
         if configuration is None:
             raise ValueError("Configuration is not defined")
+        self.client = create_async_client(api_key, configuration)
+        self._api = ResilientOpenAIClient(configuration)
         self._chat_model_name = configuration.chat_model_name
         self._image_size = configuration.image_size
+        self._image_edit_model_name = getattr(configuration, 'image_edit_model_name', None) or "dall-e-2"
+        self._vision_detail = getattr(configuration, 'vision_detail', None) or "high"
         size = configuration.image_size.split('x')
         self._image_w = int(size[0])
         self._image_h = int(size[1])
@@ -30,65 +261,218 @@ class OpenAI:
         self._temperature = configuration.temperature
         self._tokens_per_message = configuration.tokens_per_message
         self._tokens_per_name = configuration.tokens_per_name
+        self._system_prompt = getattr(configuration, 'system_prompt', None)
+        self._prompt_tokens = 0
+        self._cached_tokens = 0
+        self._encoding = None
+        tiktoken_cache_dir = getattr(configuration, 'tiktoken_cache_dir', None)
+        if tiktoken_cache_dir:
+            # tiktoken reads and fills this folder instead of downloading the BPE file every time,
+            # a configured folder wins over the TIKTOKEN_CACHE_DIR of the environment
+            os.environ['TIKTOKEN_CACHE_DIR'] = tiktoken_cache_dir
+        self._flights = SingleFlight(getattr(configuration, 'coalesce_window', None) or 0)
+        self.cache = ResponseCache(
+            max_entries=getattr(configuration, 'cache_max_entries', None) or 512,
+            ttl=getattr(configuration, 'cache_ttl', None) or 3600,
+            disk_dir=getattr(configuration, 'cache_dir', None),
+        )
+        REGISTRY.counter(
+            'response_cache_lookups_total', 'Response cache lookups by result', ('result',),
+            callback=lambda: {('hit',): self.cache.hits, ('miss',): self.cache.misses},
+        )
+        REGISTRY.gauge(
+            'response_cache_entries', 'Entries in the response cache', ('tier',),
+            callback=lambda: {('memory',): self.cache.stats()["entries"], ('disk',): self.cache.stats()["disk_entries"]},
+        )
+        REGISTRY.gauge(
+            'openai_prompt_cache_hit_ratio', 'Share of all prompt tokens served from the provider prompt cache',
+            callback=lambda: {(): self.get_prompt_cache_stats()["hit_ratio"]},
+        )
+
+    def _record_usage(self, usage):
+        if usage is None:
+            return
+        prompt_tokens = usage.prompt_tokens or 0
+        details = getattr(usage, 'prompt_tokens_details', None)
+        cached_tokens = (getattr(details, 'cached_tokens', None) or 0) if details is not None else 0
+        TOKENS_USED.inc(prompt_tokens, model=self._chat_model_name, kind='prompt')
+        TOKENS_USED.inc(cached_tokens, model=self._chat_model_name, kind='cached')
+        TOKENS_USED.inc(usage.completion_tokens or 0, model=self._chat_model_name, kind='completion')
+        if prompt_tokens:
+            self._prompt_tokens += prompt_tokens
+            self._cached_tokens += cached_tokens
+            PROMPT_CACHED.observe(cached_tokens / prompt_tokens)
 
-    async def get_chat_message_response(self, messages: list, user_id: int) -> Tuple[str | None, Exception | None]:
+    def _chat_cache_key(self, messages: list) -> str:
+        params = {"max_tokens": self._max_tokens, "temperature": self._temperature}
+        return self.cache.make_key("chat.completions", self._chat_model_name, params, messages)
+
+    def get_image_cache_key(self, prompt: str) -> str:
+        return self.cache.make_key("images.generate", "", {"size": self._image_size, "quality": "standard"}, prompt)
+
+    def get_voice_cache_key(self, text: str) -> str:
+        return self.cache.make_key("audio.speech", "tts-1", {"voice": "nova", "response_format": "opus"}, text)
+
+    async def get_chat_message_response(self, messages: list, user_id: int, use_cache=False) -> Tuple[str | None, Exception | None]:
+        """Completion text for messages, with use_cache identical prompts are also coalesced while in flight"""
+        cache_key = self._chat_cache_key(messages) if use_cache else None
+        if cache_key is not None:
+            cached = self.cache.get(cache_key)
+            if cached is not None:
+                return cached, None
         try:
-            response = await self.client.chat.completions.create(
-                model=self._chat_model_name,
-                messages=messages,
-                max_tokens=self._max_tokens,
-                temperature=self._temperature,
-                user=str(user_id),
-            )
+            if cache_key is not None:
+                content = await self._flights.do(cache_key, lambda: self._create_chat_completion(messages, user_id), "chat")
+            else:
+                content = await self._create_chat_completion(messages, user_id)
+        except OpenAIException as e:
+            return None, e
         except Exception as e:
             return None, OpenAIException("Ошибка: " + str(e))
+        if content and cache_key is not None:
+            self.cache.set(cache_key, content)
+        return content, None
+
+    async def _create_chat_completion(self, messages: list, user_id: int) -> str | None:
+        response = await self._api.call("chat", lambda timeout: self.client.chat.completions.create(
+            model=self._chat_model_name,
+            messages=messages,
+            max_tokens=self._max_tokens,
+            temperature=self._temperature,
+            user=str(user_id),
+            prompt_cache_key=str(user_id),
+            timeout=timeout,
+        ), hedge=True)
+        self._record_usage(response.usage)
         dict_data = response.to_dict()
         choises = dict_data.get('choices', [])
         if not choises:
-            return None, OpenAIException("Вариантов ответа не получено")
-        choise = choises[0]
-        message = choise.get('message', None)
+            raise OpenAIException("Вариантов ответа не получено")
+        message = choises[0].get('message', None)
         if message:
-            content = message.get('content', None)
-            if content:
-                return content, None
+            return message.get('content', None) or None
         return None
 
-    async def transcribe_voice_message(self, filename: str) -> Tuple[str | None, Exception | None]:
+    async def get_chat_message_stream(self, messages: list, user_id: int, use_cache=False) -> AsyncIterator[str]:
+        """Yield the completion text as it is generated, raises OpenAIException on failure"""
+        cache_key = self._chat_cache_key(messages) if use_cache else None
+        flight = None
+        if cache_key is not None:
+            cached = self.cache.get(cache_key)
+            if cached is not None:
+                yield cached
+                return
+            shared = self._flights.join(cache_key, "chat")
+            if shared is not None:
+                # an identical prompt is already being answered, its text arrives in one piece
+                try:
+                    content = await asyncio.shield(shared)
+                except OpenAIException:
+                    raise
+                except Exception as e:
+                    raise OpenAIException("Ошибка: " + str(e)) from e
+                if content:
+                    yield content
+                return
+            flight = self._flights.start(cache_key)
+        parts = []
         try:
-            with open(filename, "rb") as audio:
-                result = await self.client.audio.transcriptions.create(model="whisper-1", file=audio, prompt="Необходимо распознать речь")
-                return result.text, None
+            stream = await self._api.call("chat", lambda timeout: self.client.chat.completions.create(
+                model=self._chat_model_name,
+                messages=messages,
+                max_tokens=self._max_tokens,
+                temperature=self._temperature,
+                user=str(user_id),
+                prompt_cache_key=str(user_id),
+                stream=True,
+                stream_options={"include_usage": True},
+                timeout=timeout,
+            ), sample_latency=False)
+            async for chunk in stream:
+                # with include_usage the last chunk has no choices and carries the usage
+                self._record_usage(chunk.usage)
+                if not chunk.choices:
+                    continue
+                content = chunk.choices[0].delta.content
+                if content:
+                    parts.append(content)
+                    yield content
+        except BaseException as e:
+            if flight is not None:
+                self._flights.finish(cache_key, flight, error=e)
+            if isinstance(e, Exception):
+                raise OpenAIException("Ошибка: " + str(e)) from e
+            raise
+        if cache_key is not None and parts:
+            self.cache.set(cache_key, "".join(parts))
+        if flight is not None:
+            self._flights.finish(cache_key, flight, result="".join(parts) or None)
+
+    async def transcribe_voice_message(self, audio: tuple) -> Tuple[str | None, Exception | None]:
+        """Transcribe a (filename, bytes) audio file, the extension tells the API the format"""
+        try:
+            result = await self._api.call("transcriptions", lambda timeout: self.client.audio.transcriptions.create(
+                model="whisper-1", file=audio, prompt="Необходимо распознать речь", timeout=timeout
+            ))
+            return result.text, None
         except Exception as e:
-            None, OpenAIException("Ошибка: " + str(e))
-        return None
+            return None, OpenAIException("Ошибка: " + str(e))
 
     async def text_to_voice(self, text: str) -> BytesIO | None:
+        cache_key = self.get_voice_cache_key(text)
+        data = await self.cache.get_bytes(cache_key)
+        if data is not None:
+            return io.BytesIO(data)
         try:
-            response = await self.client.audio.speech.create(model="tts-1",  voice="nova", input=text, response_format='opus')
-            temp_file = io.BytesIO()
-            temp_file.write(response.read())
-            temp_file.seek(0)
-            return temp_file
+            data = await self._flights.do(cache_key, lambda: self._create_speech(text), "speech")
+            await self.cache.set_bytes(cache_key, data)
+            return io.BytesIO(data)
         except Exception as e:
             print(e)
         return None
 
+    async def _create_speech(self, text: str) -> bytes:
+        async def request(timeout):
+            # the body is read in chunks as it arrives instead of being buffered by the client first
+            async with self.client.audio.speech.with_streaming_response.create(
+                model="tts-1", voice="nova", input=text, response_format='opus', timeout=timeout
+            ) as response:
+                data = bytearray()
+                async for chunk in response.iter_bytes(self.SPEECH_CHUNK_SIZE):
+                    data.extend(chunk)
+                return bytes(data)
+        return await self._api.call("speech", request)
+
     async def get_image_create_response(self, prompt: str) -> Tuple[str | None, Exception | None]:
+        cache_key = self.get_image_cache_key(prompt)
+        image_url = self.cache.get(cache_key)
+        if image_url is not None:
+            return image_url, None
         try:
-            response = await self.client.images.generate(prompt=prompt, n=1, size=self._image_size, quality="standard")
-            image_url = response.data[0].url
+            image_url = await self._flights.do(cache_key, lambda: self._create_image(prompt), "images")
+            self.cache.set(cache_key, image_url, ttl=self.IMAGE_URL_TTL)
             return image_url, None
         except Exception as e:
             return None, OpenAIException("OpenAI: " + str(e))
 
-    async def get_image_variation_response(self, buffer: BytesIO, mask: BytesIO, prompt: str):
+    async def _create_image(self, prompt: str) -> str:
+        response = await self._api.call("images", lambda timeout: self.client.images.generate(
+            prompt=prompt, n=1, size=self._image_size, quality="standard", timeout=timeout
+        ))
+        return response.data[0].url
+
+    async def get_image_edit_response(self, image: bytes, mask: bytes, prompt: str) -> Tuple[str | None, Exception | None]:
+        """Edit a square RGBA PNG of the configured image size by the prompt where mask is transparent, returns the result url"""
         try:
-            response = await openai.Image.acreate_edit(image=buffer, mask=mask, prompt=prompt, n=1, size=self._image_size)
-            image_url = response['data'][0]['url']
+            response = await self._api.call("images", lambda timeout: self.client.images.edit(
+                model=self._image_edit_model_name, image=('image.png', image), mask=('mask.png', mask), prompt=prompt, n=1,
+                size=self._image_size, timeout=timeout
+            ))
         except Exception as e:
-            return "Response error: " + str(e)
-        return image_url
+            return None, OpenAIException("OpenAI: " + str(e))
+        if not response.data or not response.data[0].url:
+            return None, OpenAIException("OpenAI не вернул изменённую картинку")
+        return response.data[0].url, None
 
     def get_image_to_change(self, images: dict):
         nearest = -1
@@ -103,34 +487,66 @@ class OpenAI:
         return nearest_id,  self._image_w, self._image_h
 
     def count_tokens(self, messages) -> int:
-        model = self._chat_model_name
-        try:
-            encoding = tiktoken.encoding_for_model(model)
-        except KeyError:
-            raise ValueError(f"Model {model} not recognised")
-        tokens_per_message = self._tokens_per_message
-        tokens_per_name = self._tokens_per_name
         num_tokens = 0
         for message in messages:
-            num_tokens += tokens_per_message
-            for key, value in message.items():
-                if key == 'content':
-                    if isinstance(value, str):
-                        num_tokens += len(encoding.encode(value))
-                    # else:
-                    #     for message1 in value:
-                    #         if message1['type'] == 'image_url':
-                    #             image = decode_image(message1['image_url']['url'])
-                    #             num_tokens += self.__count_tokens_vision(image)
-                    #         else:
-                    #             num_tokens += len(encoding.encode(message1['text']))
-                else:
-                    num_tokens += len(encoding.encode(value))
-                    if key == "name":
-                        num_tokens += tokens_per_name
+            num_tokens += self.count_message_tokens(message)
         num_tokens += 3
         return num_tokens
 
+    def get_encoding(self):
+        if self._encoding is None:
+            self._encoding = load_encoding(self._chat_model_name)
+        return self._encoding
+
+    def warm_up(self):
+        """Load the tokenizer before the first update so the first reply does not wait for it"""
+        self.get_encoding().encode("warm up")
+
+    def count_message_tokens(self, message: dict) -> int:
+        encoding = self.get_encoding()
+        num_tokens = self._tokens_per_message
+        for key, value in message.items():
+            if key == 'content':
+                if isinstance(value, str):
+                    num_tokens += len(encoding.encode(value))
+                else:
+                    for part in value:
+                        if part['type'] == 'image_url':
+                            num_tokens += self.count_image_tokens(part['image_url'])
+                        else:
+                            num_tokens += len(encoding.encode(part['text']))
+            else:
+                num_tokens += len(encoding.encode(value))
+                if key == "name":
+                    num_tokens += self._tokens_per_name
+        return num_tokens
+
+    def count_image_tokens(self, image_url: dict) -> int:
+        """An image part of unknown size is counted as the largest one the model bills for"""
+        return count_vision_tokens(VISION_SHORT_SIDE, VISION_MAX_SIDE, detail=image_url.get('detail', 'auto'))
+
+    def get_vision_detail(self) -> str:
+        return self._vision_detail
+
+    def get_system_prompt(self) -> str | None:
+        return self._system_prompt
+
+    def get_prompt_cache_stats(self) -> dict:
+        return {
+            "prompt_tokens": self._prompt_tokens,
+            "cached_tokens": self._cached_tokens,
+            "hit_ratio": self._cached_tokens / self._prompt_tokens if self._prompt_tokens else 0.0,
+        }
+
+    def get_api_stats(self) -> dict:
+        stats = self._api.stats()
+        stats["single_flight"] = self._flights.stats()
+        stats["prompt_cache"] = self.get_prompt_cache_stats()
+        return stats
+
+    def get_context_budget(self) -> int:
+        return self._max_tokens
+
     def needs_summarization(self, tokens_count) -> bool:
         if tokens_count < self._max_tokens:
             return False
@@ -0,0 +1,230 @@
+import asyncio
+import random
+import time
+from collections import deque
+from typing import Awaitable, Callable
+
+import httpx
+import openai
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient
+
+from .errors import OpenAIException
+from .metrics import REGISTRY
+
+
+RETRYABLE_ERRORS = (
+    openai.APITimeoutError,
+    openai.APIConnectionError,
+    openai.RateLimitError,
+    openai.InternalServerError,
+)
+
+REQUEST_LATENCY = REGISTRY.histogram(
+    'openai_request_seconds', 'Latency of successful OpenAI API calls including retries', ('endpoint',)
+)
+REQUEST_ERRORS = REGISTRY.counter('openai_request_errors_total', 'Failed OpenAI API attempts', ('endpoint', 'error'))
+REQUEST_RETRIES = REGISTRY.counter('openai_request_retries_total', 'Retried OpenAI API attempts', ('endpoint',))
+
+
+def create_async_client(api_key: str, configuration) -> AsyncOpenAI:
+    """AsyncOpenAI with a sized keep-alive connection pool, retries are left to ResilientOpenAIClient"""
+    limits = httpx.Limits(
+        max_connections=getattr(configuration, 'http_max_connections', None) or 100,
+        max_keepalive_connections=getattr(configuration, 'http_max_keepalive_connections', None) or 20,
+        keepalive_expiry=getattr(configuration, 'http_keepalive_expiry', None) or 30,
+    )
+    return AsyncOpenAI(
+        api_key=api_key,
+        base_url=getattr(configuration, 'api_base_url', None),
+        max_retries=0,
+        http_client=DefaultAsyncHttpxClient(limits=limits),
+    )
+
+
+class CircuitBreaker:
+    """Opens after failure_threshold consecutive failures and lets one trial call through after reset_timeout"""
+
+    def __init__(self, failure_threshold: int, reset_timeout: float):
+        self._failure_threshold = failure_threshold
+        self._reset_timeout = reset_timeout
+        self._failures = 0
+        self._opened_at = None
+        self._trial = False
+
+    @property
+    def state(self) -> str:
+        if self._opened_at is None:
+            return 'closed'
+        if time.monotonic() - self._opened_at >= self._reset_timeout:
+            return 'half-open'
+        return 'open'
+
+    def allow(self) -> bool:
+        state = self.state
+        if state == 'closed':
+            return True
+        if state == 'half-open' and not self._trial:
+            self._trial = True
+            return True
+        return False
+
+    @property
+    def trial(self) -> bool:
+        return self._trial
+
+    def release_trial(self):
+        """The trial call ended without a result, e.g. it was cancelled, the next call may try again"""
+        self._trial = False
+
+    def record_success(self):
+        self._failures = 0
+        self._opened_at = None
+        self._trial = False
+
+    def record_failure(self):
+        self._failures += 1
+        self._trial = False
+        if self._opened_at is not None or self._failures >= self._failure_threshold:
+            self._opened_at = time.monotonic()
+
+
+class ResilientOpenAIClient:
+    """Runs API requests with per-endpoint timeouts, retries and a circuit breaker.
+
+    Retryable errors (timeouts, connection errors, 429, 5xx) are retried with jittered
+    exponential backoff. Hedged requests start a second identical request when the first
+    is slower than the hedge_percentile of recent latencies and use whichever ends first.
+    """
+
+    DEFAULT_TIMEOUTS = {"chat": 60, "images": 120, "speech": 60, "transcriptions": 60}
+    LATENCY_SAMPLES = 200
+    MIN_HEDGE_SAMPLES = 20
+
+    def __init__(self, configuration):
+        timeouts = getattr(configuration, 'request_timeouts', None)
+        self._timeouts = {
+            endpoint: getattr(timeouts, endpoint, None) or default for endpoint, default in self.DEFAULT_TIMEOUTS.items()
+        }
+        self._max_retries = getattr(configuration, 'max_retries', None)
+        if self._max_retries is None:
+            self._max_retries = 2
+        self._retry_base_delay = getattr(configuration, 'retry_base_delay', None) or 0.5
+        self._hedge = bool(getattr(configuration, 'hedge_requests', False))
+        self._hedge_percentile = getattr(configuration, 'hedge_percentile', None) or 0.95
+        self._failure_threshold = getattr(configuration, 'circuit_failure_threshold', None) or 5
+        self._reset_timeout = getattr(configuration, 'circuit_reset_timeout', None) or 30
+        self._breakers = {}
+        self._latencies = {}
+        self.hedged = 0
+        self.hedge_wins = 0
+
+    def _breaker(self, endpoint: str) -> CircuitBreaker:
+        breaker = self._breakers.get(endpoint)
+        if breaker is None:
+            breaker = CircuitBreaker(self._failure_threshold, self._reset_timeout)
+            self._breakers[endpoint] = breaker
+        return breaker
+
+    async def call(self, endpoint: str, request: Callable[[float], Awaitable], hedge=False, sample_latency=True):
+        """Run request(timeout) for endpoint, raises OpenAIException when the circuit is open.
+
+        Pass sample_latency=False when the request returns before the response is complete,
+        e.g. a stream, so its latency does not shorten the hedge delay of whole requests.
+        """
+        breaker = self._breaker(endpoint)
+        if not breaker.allow():
+            raise OpenAIException("Сервис OpenAI временно недоступен, попробуйте позже")
+        trial = breaker.trial
+        try:
+            return await self._call(endpoint, request, hedge, sample_latency, breaker)
+        except BaseException:
+            # a cancelled trial call must not keep the circuit half-open forever
+            if trial and breaker.trial:
+                breaker.release_trial()
+            raise
+
+    async def _call(self, endpoint: str, request: Callable[[float], Awaitable], hedge: bool, sample_latency: bool,
+                    breaker: CircuitBreaker):
+        timeout = self._timeouts.get(endpoint, 60)
+        attempt = 0
+        first_started = time.monotonic()
+        while True:
+            started = time.monotonic()
+            try:
+                if hedge and self._hedge:
+                    result = await self._hedged(endpoint, request, timeout)
+                else:
+                    result = await request(timeout)
+            except RETRYABLE_ERRORS as e:
+                REQUEST_ERRORS.inc(endpoint=endpoint, error=type(e).__name__)
+                if attempt >= self._max_retries:
+                    breaker.record_failure()
+                    raise
+                attempt += 1
+                REQUEST_RETRIES.inc(endpoint=endpoint)
+                await asyncio.sleep(self._backoff(attempt))
+                continue
+            except Exception as e:
+                REQUEST_ERRORS.inc(endpoint=endpoint, error=type(e).__name__)
+                # client errors (4xx) say nothing about the upstream health
+                breaker.record_success()
+                raise
+            breaker.record_success()
+            now = time.monotonic()
+            if sample_latency:
+                self._record_latency(endpoint, now - started)
+            REQUEST_LATENCY.observe(now - first_started, endpoint=endpoint)
+            return result
+
+    def _backoff(self, attempt: int) -> float:
+        delay = self._retry_base_delay * 2 ** (attempt - 1)
+        return random.uniform(0, delay) + delay / 2
+
+    def _record_latency(self, endpoint: str, latency: float):
+        samples = self._latencies.get(endpoint)
+        if samples is None:
+            samples = deque(maxlen=self.LATENCY_SAMPLES)
+            self._latencies[endpoint] = samples
+        samples.append(latency)
+
+    def _hedge_delay(self, endpoint: str) -> float | None:
+        samples = self._latencies.get(endpoint)
+        if samples is None or len(samples) < self.MIN_HEDGE_SAMPLES:
+            return None
+        ordered = sorted(samples)
+        return ordered[min(len(ordered) - 1, int(self._hedge_percentile * len(ordered)))]
+
+    async def _hedged(self, endpoint: str, request: Callable[[float], Awaitable], timeout: float):
+        delay = self._hedge_delay(endpoint)
+        first = asyncio.ensure_future(request(timeout))
+        pending = {first}
+        try:
+            if delay is None or delay >= timeout:
+                return await first
+            done, pending = await asyncio.wait(pending, timeout=delay)
+            if done:
+                return first.result()
+            self.hedged += 1
+            second = asyncio.ensure_future(request(timeout - delay))
+            pending = {first, second}
+            error = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is second:
+                            self.hedge_wins += 1
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            # asyncio.wait leaves the requests running when the caller is cancelled
+            for task in pending:
+                task.cancel()
+
+    def stats(self) -> dict:
+        return {
+            "circuits": {endpoint: breaker.state for endpoint, breaker in self._breakers.items()},
+            "hedged": self.hedged,
+            "hedge_wins": self.hedge_wins,
+        }
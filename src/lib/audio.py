@@ -0,0 +1,137 @@
+import asyncio
+import os
+import re
+from collections import deque
+from io import BytesIO
+from typing import AsyncIterator, Awaitable, Callable, List
+
+from .errors import TelegramException
+
+
+SENTENCE_END = re.compile(r'(?<=[.!?…;])\s+|\n+')
+
+
+def split_speech_segments(text: str, limit: int, first_limit: int = None) -> List[str]:
+    """Split text into segments of at most limit characters at sentence boundaries.
+
+    Sentences are packed together up to the limit, a sentence longer than the limit is cut at
+    word boundaries. The first segment is kept within first_limit, so it is synthesized quickly.
+    """
+    segments = []
+    current = ''
+    for sentence in SENTENCE_END.split(text):
+        sentence = sentence.strip()
+        if not sentence:
+            continue
+        current_limit = (first_limit or limit) if not segments else limit
+        if current and len(current) + 1 + len(sentence) <= current_limit:
+            current += ' ' + sentence
+            continue
+        if current:
+            segments.append(current)
+            current_limit = limit
+        while len(sentence) > current_limit:
+            cut = sentence.rfind(' ', 0, current_limit)
+            if cut <= 0:
+                cut = current_limit
+            segments.append(sentence[:cut].rstrip())
+            sentence = sentence[cut:].lstrip()
+            current_limit = limit
+        current = sentence
+    if current:
+        segments.append(current)
+    return segments
+
+
+class VoicePipeline:
+    """Gets Telegram voice and audio messages ready for transcription without touching the disk.
+
+    Files are downloaded into memory and passed on as is when the transcription API accepts
+    the format (Telegram voice notes are OGG/Opus), anything else is converted to mp3 through
+    an ffmpeg pipe with a bounded number of concurrent ffmpeg processes.
+    """
+
+    ACCEPTED_FORMATS = {'flac', 'm4a', 'mp3', 'mp4', 'mpeg', 'mpga', 'oga', 'ogg', 'wav', 'webm'}
+    MIME_FORMATS = {
+        'audio/ogg': 'ogg',
+        'audio/opus': 'ogg',
+        'audio/mpeg': 'mp3',
+        'audio/mp4': 'm4a',
+        'audio/x-m4a': 'm4a',
+        'audio/wav': 'wav',
+        'audio/x-wav': 'wav',
+        'audio/flac': 'flac',
+        'audio/webm': 'webm',
+    }
+    DEFAULT_TRANSCODE_WORKERS = 2
+
+    def __init__(self, transcode_workers: int = None):
+        self._transcode_semaphore = asyncio.BoundedSemaphore(transcode_workers or self.DEFAULT_TRANSCODE_WORKERS)
+
+    async def get_transcription_file(self, bot, attachment) -> tuple:
+        """Return a (filename, bytes) pair for the transcription API"""
+        media_file = await bot.get_file(attachment.file_id)
+        data = bytes(await media_file.download_as_bytearray())
+        audio_format = self._get_format(attachment, media_file)
+        if audio_format in self.ACCEPTED_FORMATS:
+            return f'{attachment.file_unique_id}.{audio_format}', data
+        data = await self.transcode(data)
+        return f'{attachment.file_unique_id}.mp3', data
+
+    def _get_format(self, attachment, media_file) -> str | None:
+        mime_type = getattr(attachment, 'mime_type', None)
+        if mime_type in self.MIME_FORMATS:
+            return self.MIME_FORMATS[mime_type]
+        file_path = getattr(media_file, 'file_path', None) or ''
+        extension = os.path.splitext(file_path)[1].lstrip('.').lower()
+        return extension or None
+
+    async def transcode(self, data: bytes, audio_format: str = 'mp3') -> bytes:
+        async with self._transcode_semaphore:
+            process = await asyncio.create_subprocess_exec(
+                'ffmpeg', '-hide_banner', '-loglevel', 'error', '-i', 'pipe:0', '-f', audio_format, 'pipe:1',
+                stdin=asyncio.subprocess.PIPE,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE,
+            )
+            output, errors = await process.communicate(data)
+        if process.returncode != 0:
+            raise TelegramException("ffmpeg: " + errors.decode(errors='replace').strip())
+        return output
+
+
+class SpeechPipeline:
+    """Turns a long reply into a sequence of voice messages.
+
+    The text is split at sentence boundaries and the segments are synthesized concurrently,
+    at most `concurrency` of them ahead of the one being delivered. Segments are yielded in
+    order as soon as they and the ones before them are ready, so the first voice message
+    follows one short segment and at most `concurrency` synthesized segments are held.
+    """
+
+    DEFAULT_SEGMENT_CHARS = 600
+    DEFAULT_FIRST_SEGMENT_CHARS = 200
+    DEFAULT_CONCURRENCY = 3
+
+    def __init__(self, synthesize: Callable[[str], Awaitable[BytesIO | None]], segment_chars: int = None,
+                 first_segment_chars: int = None, concurrency: int = None):
+        self._synthesize = synthesize
+        self._segment_chars = segment_chars or self.DEFAULT_SEGMENT_CHARS
+        self._first_segment_chars = min(first_segment_chars or self.DEFAULT_FIRST_SEGMENT_CHARS, self._segment_chars)
+        self._concurrency = concurrency or self.DEFAULT_CONCURRENCY
+
+    async def synthesize(self, text: str) -> AsyncIterator[BytesIO]:
+        """Yield the voice of every segment of text in order, stops at the first segment that fails"""
+        segments = deque(split_speech_segments(text, self._segment_chars, self._first_segment_chars))
+        pending = deque()
+        try:
+            while segments or pending:
+                while segments and len(pending) < self._concurrency:
+                    pending.append(asyncio.create_task(self._synthesize(segments.popleft())))
+                audio = await pending.popleft()
+                if audio is None:
+                    return
+                yield audio
+        finally:
+            for task in pending:
+                task.cancel()
@@ -0,0 +1,80 @@
+import asyncio
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+
+class ChatUpdateProcessor(BaseUpdateProcessor):
+    """Processes updates of different chats concurrently while keeping updates of one chat in order.
+
+    Handlers run under a shared limit of concurrent_updates. Cheap commands (/help, /info, /stats)
+    go through a separate small lane so they are never queued behind LLM calls.
+    """
+
+    DEFAULT_CONCURRENT_UPDATES = 32
+    DEFAULT_FAST_LANE_UPDATES = 4
+    MAX_PENDING_UPDATES = 1024
+    FAST_COMMANDS = ('help', 'info', 'stats')
+
+    def __init__(self, concurrent_updates: int = None, fast_lane_updates: int = None, fast_commands=None):
+        # The base semaphore only bounds the number of pending handlers, the lanes below bound the work
+        super().__init__(self.MAX_PENDING_UPDATES)
+        self._concurrent_updates = concurrent_updates or self.DEFAULT_CONCURRENT_UPDATES
+        self._fast_lane_updates = fast_lane_updates or self.DEFAULT_FAST_LANE_UPDATES
+        self._fast_commands = {f'/{command}' for command in (fast_commands or self.FAST_COMMANDS)}
+        self._semaphore_slow = asyncio.BoundedSemaphore(self._concurrent_updates)
+        self._semaphore_fast = asyncio.BoundedSemaphore(self._fast_lane_updates)
+        self._chat_locks = {}
+
+    async def do_process_update(self, update: object, coroutine) -> None:
+        if self._is_fast_update(update):
+            async with self._semaphore_fast:
+                await coroutine
+            return
+        key = self._ordering_key(update)
+        if key is None:
+            async with self._semaphore_slow:
+                await coroutine
+            return
+        lock = self._acquire_chat_lock(key)
+        try:
+            async with lock[0]:
+                async with self._semaphore_slow:
+                    await coroutine
+        finally:
+            self._release_chat_lock(key, lock)
+
+    def _is_fast_update(self, update: object) -> bool:
+        if not isinstance(update, Update) or update.message is None or not update.message.text:
+            return False
+        command = update.message.text.split(maxsplit=1)[0].split('@', 1)[0].lower()
+        return command in self._fast_commands
+
+    @staticmethod
+    def _ordering_key(update: object):
+        if not isinstance(update, Update):
+            return None
+        if update.effective_chat is not None:
+            return update.effective_chat.id
+        if update.effective_user is not None:
+            return update.effective_user.id
+        return None
+
+    def _acquire_chat_lock(self, key) -> list:
+        lock = self._chat_locks.get(key)
+        if lock is None:
+            lock = [asyncio.Lock(), 0]
+            self._chat_locks[key] = lock
+        lock[1] += 1
+        return lock
+
+    def _release_chat_lock(self, key, lock: list):
+        lock[1] -= 1
+        if lock[1] == 0 and self._chat_locks.get(key) is lock:
+            del self._chat_locks[key]
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
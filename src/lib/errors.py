@@ -3,4 +3,12 @@ class TelegramException(Exception):
 
 
 class OpenAIException(Exception):
-    pass
\ No newline at end of file
+    pass
+
+
+class AdmissionException(Exception):
+
+    def __init__(self, reason: str, retry_after: float = 0.0):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
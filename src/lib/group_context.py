@@ -0,0 +1,180 @@
+import asyncio
+import json
+import os
+from collections import OrderedDict
+
+
+class GroupContextEntry:
+
+    __slots__ = ('message_id', 'reply_to', 'role', 'name', 'content', 'tokens')
+
+    def __init__(self, message_id: int, reply_to: int | None, role: str, name: str | None, content: str, tokens: int):
+        self.message_id = message_id
+        self.reply_to = reply_to
+        self.role = role
+        self.name = name
+        self.content = content
+        self.tokens = tokens
+
+    def to_message(self) -> dict:
+        message = {"role": self.role, "content": self.content}
+        if self.name:
+            message["name"] = self.name
+        return message
+
+    def dump(self) -> list:
+        return [self.message_id, self.reply_to, self.role, self.name, self.content, self.tokens]
+
+
+class GroupContextBuffer:
+    """Ring buffer of the recent messages of one group, bounded by message count and tokens"""
+
+    def __init__(self, max_messages: int, max_tokens: int):
+        self._max_messages = max_messages
+        self._max_tokens = max_tokens
+        self._entries = OrderedDict()
+        self.tokens = 0
+
+    def add(self, entry: GroupContextEntry):
+        previous = self._entries.pop(entry.message_id, None)
+        if previous is not None:
+            # an edited or streamed message replaces its earlier text
+            self.tokens -= previous.tokens
+        self._entries[entry.message_id] = entry
+        self.tokens += entry.tokens
+        while len(self._entries) > 1 and (len(self._entries) > self._max_messages or self.tokens > self._max_tokens):
+            _, oldest = self._entries.popitem(last=False)
+            self.tokens -= oldest.tokens
+
+    def thread(self, message_id: int, max_tokens: int, max_depth: int) -> tuple:
+        """Follow reply links from message_id back, returns (messages oldest first, their tokens)"""
+        entries = []
+        tokens = 0
+        entry = self._entries.get(message_id)
+        while entry is not None and len(entries) < max_depth:
+            if tokens + entry.tokens > max_tokens:
+                break
+            entries.append(entry)
+            tokens += entry.tokens
+            if entry.reply_to is None or entry.reply_to == entry.message_id:
+                break
+            entry = self._entries.get(entry.reply_to)
+        entries.reverse()
+        return [entry.to_message() for entry in entries], tokens
+
+    def dump(self) -> list:
+        return [entry.dump() for entry in self._entries.values()]
+
+    def load(self, entries: list):
+        for data in entries:
+            self.add(GroupContextEntry(*data))
+
+
+class GroupContextStore:
+    """Recent messages of every group, so a reply to the bot can be answered with its whole reply thread.
+
+    Telegram only sends the message a reply points to, not the chain behind it. Group messages
+    and bot replies are recorded here with their token counts as they pass by, a thread is then
+    rebuilt by following reply_to links in O(depth). At most max_groups groups are kept (least
+    recently active are dropped), with state_file the buffers are saved periodically and on stop.
+    """
+
+    DEFAULT_MAX_MESSAGES = 200
+    DEFAULT_MAX_TOKENS = 8000
+    DEFAULT_MAX_GROUPS = 500
+    DEFAULT_MAX_DEPTH = 20
+    SAVE_INTERVAL = 30
+
+    def __init__(self, configuration, state_file: str = None):
+        self._max_messages = getattr(configuration, 'group_context_messages', None) or self.DEFAULT_MAX_MESSAGES
+        self._max_tokens = getattr(configuration, 'group_context_tokens', None) or self.DEFAULT_MAX_TOKENS
+        self._max_groups = getattr(configuration, 'group_context_groups', None) or self.DEFAULT_MAX_GROUPS
+        self._max_depth = getattr(configuration, 'group_context_depth', None) or self.DEFAULT_MAX_DEPTH
+        self._state_file = state_file
+        self._groups = OrderedDict()
+        self._token_counter = None
+        self._changed = False
+        self._save_task = None
+
+    def set_token_counter(self, token_counter):
+        self._token_counter = token_counter
+
+    def _buffer(self, chat_id: int) -> GroupContextBuffer:
+        buffer = self._groups.get(chat_id)
+        if buffer is None:
+            buffer = GroupContextBuffer(self._max_messages, self._max_tokens)
+            self._groups[chat_id] = buffer
+            while len(self._groups) > self._max_groups:
+                self._groups.popitem(last=False)
+        else:
+            self._groups.move_to_end(chat_id)
+        return buffer
+
+    def record(self, chat_id: int, message_id: int, reply_to: int | None, role: str, content: str, name: str = None):
+        if not content:
+            return
+        entry = GroupContextEntry(message_id, reply_to, role, name, content, 0)
+        entry.tokens = self._token_counter(entry.to_message()) if self._token_counter is not None else 0
+        self._buffer(chat_id).add(entry)
+        self._changed = True
+
+    def get_thread(self, chat_id: int, message_id: int, max_tokens: int) -> tuple:
+        """Return (messages, tokens) of the reply thread ending with message_id, empty if it is unknown"""
+        buffer = self._groups.get(chat_id)
+        if buffer is None:
+            return [], 0
+        return buffer.thread(message_id, min(max_tokens, self._max_tokens), self._max_depth)
+
+    def stats(self) -> dict:
+        return {
+            "groups": len(self._groups),
+            "tokens": sum(buffer.tokens for buffer in self._groups.values()),
+        }
+
+    async def start(self):
+        if self._state_file:
+            await asyncio.to_thread(self._load)
+            self._save_task = asyncio.create_task(self._save_loop())
+
+    async def stop(self):
+        if self._save_task is not None:
+            self._save_task.cancel()
+            try:
+                await self._save_task
+            except asyncio.CancelledError:
+                pass
+            self._save_task = None
+        await self.save()
+
+    async def _save_loop(self):
+        while True:
+            await asyncio.sleep(self.SAVE_INTERVAL)
+            try:
+                await self.save()
+            except Exception as e:
+                print("Error saving group context: ", e)
+
+    async def save(self):
+        if not self._state_file or not self._changed:
+            return
+        state = {str(chat_id): buffer.dump() for chat_id, buffer in self._groups.items()}
+        self._changed = False
+        await asyncio.to_thread(self._write, state)
+
+    def _write(self, state: dict):
+        tmp_path = self._state_file + '.tmp'
+        with open(tmp_path, 'w') as file:
+            json.dump(state, file, ensure_ascii=False)
+        os.replace(tmp_path, self._state_file)
+
+    def _load(self):
+        try:
+            with open(self._state_file, 'r') as file:
+                state = json.load(file)
+        except FileNotFoundError:
+            return
+        except json.JSONDecodeError as e:
+            print("Error loading group context: ", e)
+            return
+        for chat_id, entries in state.items():
+            self._buffer(int(chat_id)).load(entries)
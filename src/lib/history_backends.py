@@ -0,0 +1,332 @@
+import json
+import os
+import sqlite3
+import threading
+
+
+class BaseHistoryBackend:
+
+    def __init__(self, logs_folder: str):
+        self._folder = logs_folder
+
+    def load(self, user_id: int, user_name: str) -> list:
+        raise NotImplementedError
+
+    def append(self, user_id: int, user_name: str, entries: list, storage: list, tokens: list = None):
+        """Persist entries added to the end of storage since the last write, tokens are counts per storage entry"""
+        raise NotImplementedError
+
+    def replace(self, user_id: int, user_name: str, storage: list, tokens: list = None):
+        """Persist storage as the whole history, dropping what was written before"""
+        raise NotImplementedError
+
+    def write_batch(self, writes: list) -> list:
+        """Persist (user_id, user_name, rewrite, pending, storage, tokens) tuples collected by one flush.
+
+        Returns the ids of the users whose history was not written.
+        """
+        failed = []
+        for user_id, user_name, rewrite, pending, storage, tokens in writes:
+            try:
+                if rewrite:
+                    self.replace(user_id, user_name, storage, tokens)
+                else:
+                    self.append(user_id, user_name, pending, storage, tokens)
+            except Exception as e:
+                print(f"Error saving history for user {user_id}: ", e)
+                failed.append(user_id)
+        return failed
+
+    def stats(self, user_id: int) -> tuple | None:
+        """Return (messages_count, tokens_count) without loading the history, None if not supported"""
+        return None
+
+    def close(self):
+        pass
+
+    def _path(self, user_name: str, user_id: int, ext: str) -> str:
+        return f'{self._folder}/{user_name}_{user_id}.{ext}'
+
+    def _import_legacy(self, user_id: int, user_name: str) -> list:
+        """Move the {user}_{id}.txt history into this backend, returns it"""
+        legacy = JsonHistoryBackend(self._folder)
+        storage = legacy.load(user_id, user_name)
+        if storage:
+            self.replace(user_id, user_name, storage)
+            legacy.replace(user_id, user_name, [])
+        return storage
+
+    def _legacy_histories(self):
+        """(filename, user_id, user_name) of every legacy .txt history in the logs folder"""
+        for filename in os.listdir(self._folder):
+            if not filename.endswith('.txt'):
+                continue
+            user_name, _, user_id = filename[:-len('.txt')].rpartition('_')
+            if user_id.isdigit():
+                yield filename, int(user_id), user_name
+
+    def _migrate_legacy(self, migrated_already) -> int:
+        """Import the legacy histories migrated_already(user_id, user_name) is False for, returns their number"""
+        migrated = 0
+        for filename, user_id, user_name in self._legacy_histories():
+            if migrated_already(user_id, user_name):
+                continue
+            try:
+                if self.load(user_id, user_name):
+                    migrated += 1
+            except json.JSONDecodeError as e:
+                print(f"Error migrating history {filename}: ", e)
+        return migrated
+
+    @staticmethod
+    def _atomic_write(path: str, data: str):
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as file:
+            file.write(data)
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def _remove(path: str):
+        if os.path.exists(path):
+            os.remove(path)
+
+
+class JsonHistoryBackend(BaseHistoryBackend):
+    """Whole history kept as one JSON list in {user}_{id}.txt"""
+
+    def load(self, user_id: int, user_name: str) -> list:
+        try:
+            with open(self._path(user_name, user_id, 'txt'), 'r') as file:
+                return json.loads(file.read())
+        except FileNotFoundError:
+            return []
+
+    def append(self, user_id: int, user_name: str, entries: list, storage: list, tokens: list = None):
+        self.replace(user_id, user_name, storage)
+
+    def replace(self, user_id: int, user_name: str, storage: list, tokens: list = None):
+        path = self._path(user_name, user_id, 'txt')
+        if not storage:
+            return self._remove(path)
+        self._atomic_write(path, json.dumps(storage))
+
+
+class JournalHistoryBackend(BaseHistoryBackend):
+    """Append-only log with one JSON message per line in {user}_{id}.jsonl.
+
+    The log is compacted (rewritten from memory) on replace, e.g. after a summary,
+    and when it is over compact_size bytes and COMPACT_GROWTH times the size it had
+    after the last compaction, so a large history is not rewritten on every append.
+    Existing .txt histories are migrated on first load.
+    """
+
+    DEFAULT_COMPACT_SIZE = 256 * 1024
+    COMPACT_GROWTH = 2
+
+    def __init__(self, logs_folder: str, compact_size: int = None):
+        super().__init__(logs_folder)
+        self._compact_size = compact_size or self.DEFAULT_COMPACT_SIZE
+        # size of every log when it was last loaded or compacted
+        self._base_sizes = {}
+
+    def load(self, user_id: int, user_name: str) -> list:
+        path = self._path(user_name, user_id, 'jsonl')
+        try:
+            with open(path, 'r') as file:
+                storage, torn = self._parse_lines(file)
+                self._base_sizes[user_id] = os.fstat(file.fileno()).st_size
+            if torn:
+                # a crash left a partial line, rewrite the log so new appends start on a clean line
+                self.replace(user_id, user_name, storage)
+            return storage
+        except FileNotFoundError:
+            pass
+        return self._import_legacy(user_id, user_name)
+
+    @staticmethod
+    def _parse_lines(file) -> tuple:
+        storage = []
+        torn = False
+        for line in file:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                storage.append(json.loads(line))
+            except json.JSONDecodeError:
+                torn = True
+        return storage, torn
+
+    def append(self, user_id: int, user_name: str, entries: list, storage: list, tokens: list = None):
+        if not entries:
+            return
+        path = self._path(user_name, user_id, 'jsonl')
+        with open(path, 'a') as file:
+            file.write(''.join(json.dumps(entry) + '\n' for entry in entries))
+            size = file.tell()
+        if size > max(self._compact_size, self._base_sizes.get(user_id, 0) * self.COMPACT_GROWTH):
+            self.replace(user_id, user_name, storage)
+
+    def replace(self, user_id: int, user_name: str, storage: list, tokens: list = None):
+        path = self._path(user_name, user_id, 'jsonl')
+        if not storage:
+            self._base_sizes.pop(user_id, None)
+            return self._remove(path)
+        data = ''.join(json.dumps(entry) + '\n' for entry in storage)
+        self._atomic_write(path, data)
+        self._base_sizes[user_id] = len(data.encode())
+
+    def migrate_all(self) -> int:
+        """Convert every legacy .txt history in the logs folder, returns the number of migrated files"""
+        return self._migrate_legacy(lambda user_id, user_name: os.path.exists(self._path(user_name, user_id, 'jsonl')))
+
+
+class SqliteHistoryBackend(BaseHistoryBackend):
+    """All histories in one SQLite database in WAL mode, safe to share between bot workers.
+
+    Every message is a row indexed by user, flushes are written in a single transaction
+    and replace (summary, reset) swaps the user's rows atomically. Existing .txt histories
+    are imported on first load.
+    """
+
+    DEFAULT_DATABASE_NAME = 'history.sqlite3'
+
+    def __init__(self, logs_folder: str, database_path: str = None):
+        super().__init__(logs_folder)
+        self._database_path = database_path or os.path.join(logs_folder, self.DEFAULT_DATABASE_NAME)
+        self._local = threading.local()
+        self._connections = []
+        self._connections_lock = threading.Lock()
+        with self._transaction() as connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS messages ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                "user_id INTEGER NOT NULL, "
+                "role TEXT NOT NULL, "
+                "content TEXT NOT NULL, "
+                "tokens INTEGER)"
+            )
+            connection.execute("CREATE INDEX IF NOT EXISTS messages_user_id ON messages (user_id, id)")
+
+    def _connection(self) -> sqlite3.Connection:
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self._database_path, timeout=30, isolation_level=None, check_same_thread=False)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+            with self._connections_lock:
+                self._connections.append(connection)
+        return connection
+
+    def _transaction(self):
+        return _SqliteTransaction(self._connection())
+
+    def load(self, user_id: int, user_name: str) -> list:
+        rows = self._connection().execute(
+            "SELECT role, content FROM messages WHERE user_id = ? ORDER BY id", (user_id,)
+        ).fetchall()
+        if not rows:
+            return self._import_legacy(user_id, user_name)
+        return [{"role": role, "content": content} for role, content in rows]
+
+    def _has_rows(self, user_id: int) -> bool:
+        return self._connection().execute("SELECT 1 FROM messages WHERE user_id = ? LIMIT 1", (user_id,)).fetchone() is not None
+
+    def migrate_all(self) -> int:
+        """Import every legacy .txt history in the logs folder, returns the number of migrated files"""
+        return self._migrate_legacy(lambda user_id, user_name: self._has_rows(user_id))
+
+    def _insert(self, connection, user_id: int, entries: list, tokens: list = None):
+        if tokens is None:
+            tokens = [None] * len(entries)
+        connection.executemany(
+            "INSERT INTO messages (user_id, role, content, tokens) VALUES (?, ?, ?, ?)",
+            [(user_id, entry["role"], entry["content"], count) for entry, count in zip(entries, tokens)],
+        )
+
+    def _replace(self, connection, user_id: int, storage: list, tokens: list = None):
+        connection.execute("DELETE FROM messages WHERE user_id = ?", (user_id,))
+        self._insert(connection, user_id, storage, tokens)
+
+    @staticmethod
+    def _tail(tokens: list, entries: list) -> list | None:
+        if tokens is None or not entries:
+            return None
+        return tokens[-len(entries):]
+
+    def append(self, user_id: int, user_name: str, entries: list, storage: list, tokens: list = None):
+        if not entries:
+            return
+        with self._transaction() as connection:
+            self._insert(connection, user_id, entries, self._tail(tokens, entries))
+
+    def replace(self, user_id: int, user_name: str, storage: list, tokens: list = None):
+        with self._transaction() as connection:
+            self._replace(connection, user_id, storage, tokens)
+
+    def write_batch(self, writes: list) -> list:
+        """All writes in one transaction, a failed transaction leaves every history of the batch unwritten"""
+        try:
+            with self._transaction() as connection:
+                for user_id, user_name, rewrite, pending, storage, tokens in writes:
+                    if rewrite:
+                        self._replace(connection, user_id, storage, tokens)
+                    else:
+                        self._insert(connection, user_id, pending, self._tail(tokens, pending))
+        except Exception as e:
+            print("Error saving histories batch: ", e)
+            return [user_id for user_id, *_ in writes]
+        return []
+
+    def stats(self, user_id: int) -> tuple:
+        messages_count, tokens_count = self._connection().execute(
+            "SELECT COUNT(*), COALESCE(SUM(tokens), 0) FROM messages WHERE user_id = ?", (user_id,)
+        ).fetchone()
+        if messages_count == 0:
+            # no rows may be a .txt history not imported yet, it is counted by loading it
+            return None
+        return messages_count, tokens_count + 3
+
+    def close(self):
+        with self._connections_lock:
+            for connection in self._connections:
+                connection.close()
+            self._connections = []
+        self._local = threading.local()
+
+
+class _SqliteTransaction:
+
+    def __init__(self, connection: sqlite3.Connection):
+        self._connection = connection
+
+    def __enter__(self) -> sqlite3.Connection:
+        self._connection.execute("BEGIN IMMEDIATE")
+        return self._connection
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self._connection.execute("COMMIT")
+        else:
+            self._connection.execute("ROLLBACK")
+        return False
+
+
+HISTORY_BACKENDS = {
+    'json': JsonHistoryBackend,
+    'journal': JournalHistoryBackend,
+    'sqlite': SqliteHistoryBackend,
+}
+
+
+def create_history_backend(configuration) -> BaseHistoryBackend:
+    name = getattr(configuration, 'history_backend', None) or 'json'
+    if name not in HISTORY_BACKENDS:
+        raise ValueError(f'Unknown history backend: {name}')
+    logs_dir = configuration.logs_dir
+    if name == 'journal':
+        return JournalHistoryBackend(logs_dir, compact_size=getattr(configuration, 'history_compact_size', None))
+    if name == 'sqlite':
+        return SqliteHistoryBackend(logs_dir, database_path=getattr(configuration, 'history_database', None))
+    return HISTORY_BACKENDS[name](logs_dir)
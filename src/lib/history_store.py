@@ -0,0 +1,219 @@
+import asyncio
+import time
+from collections import OrderedDict
+
+from telegram import Message
+
+from .history_backends import BaseHistoryBackend
+from .metrics import REGISTRY
+from .telegram_history import TelegamUserHistory
+
+
+HISTORY_LOAD = REGISTRY.histogram('history_load_seconds', 'Time to load a user history from the backend')
+HISTORY_FLUSH = REGISTRY.histogram('history_flush_seconds', 'Time to write one batch of changed histories')
+HISTORIES_FLUSHED = REGISTRY.counter('history_flushed_total', 'User histories written by the flush task')
+
+
+class TelegramHistoryStore:
+    """Process-wide store of live user histories.
+
+    Keeps a bounded LRU of loaded histories and persists changed ones in batches
+    from a background flush task instead of rewriting the file on every message.
+    Histories idle for compress_after seconds, or pushed out of the LRU, move to a
+    cold tier of up to cold_size histories kept zlib-compressed in memory, they are
+    inflated on the next message instead of being read from the backend again.
+    """
+
+    DEFAULT_CACHE_SIZE = 1000
+    DEFAULT_FLUSH_INTERVAL = 5.0
+    DEFAULT_COMPRESS_AFTER = 600
+    DEFAULT_COLD_SIZE = 50000
+
+    def __init__(self, backend: BaseHistoryBackend, cache_size: int = None, flush_interval: float = None,
+                 compress_after: float = None, cold_size: int = None):
+        self._backend = backend
+        self._cache_size = cache_size or self.DEFAULT_CACHE_SIZE
+        self._flush_interval = flush_interval or self.DEFAULT_FLUSH_INTERVAL
+        self._compress_after = compress_after or self.DEFAULT_COMPRESS_AFTER
+        self._cold_size = cold_size or self.DEFAULT_COLD_SIZE
+        self._histories = OrderedDict()
+        self._cold = OrderedDict()
+        self._uncompressed = {}
+        self._evicted = {}
+        self._writing = {}
+        self._loading = {}
+        self._flush_lock = asyncio.Lock()
+        self._flush_task = None
+        self._token_counter = None
+        REGISTRY.gauge(
+            'history_cached_users', 'User histories held in memory', ('state',),
+            callback=lambda: {('live',): len(self._histories), ('cold',): len(self._cold), ('evicted',): len(self._evicted)},
+        )
+        REGISTRY.gauge(
+            'history_cold_bytes', 'Compressed size of the cold user histories',
+            callback=lambda: {(): sum(history.packed_size for history in self._cold.values())},
+        )
+
+    async def get_history(self, message: Message) -> TelegamUserHistory:
+        user_id = message.from_user.id
+        user_name = message.from_user.username
+        history = self._histories.get(user_id)
+        if history is not None:
+            self._histories.move_to_end(user_id)
+            history.last_used = time.monotonic()
+            return history
+        history = self._cold.pop(user_id, None) or self._evicted.pop(user_id, None) or self._writing.get(user_id)
+        self._uncompressed.pop(user_id, None)
+        if history is None:
+            loading = self._loading.get(user_id)
+            if loading is None:
+                loading = asyncio.ensure_future(asyncio.to_thread(
+                    TelegamUserHistory, user_id, user_name, self._backend, token_counter=self._token_counter
+                ))
+                started = time.perf_counter()
+                loading.add_done_callback(lambda _: HISTORY_LOAD.observe(time.perf_counter() - started))
+                self._loading[user_id] = loading
+            try:
+                history = await asyncio.shield(loading)
+            finally:
+                if self._loading.get(user_id) is loading:
+                    del self._loading[user_id]
+            current = self._histories.get(user_id)
+            if current is not None:
+                return current
+        history.last_used = time.monotonic()
+        self._histories[user_id] = history
+        self._evict_if_need()
+        return history
+
+    def _evict_if_need(self):
+        while len(self._histories) > self._cache_size:
+            user_id, history = self._histories.popitem(last=False)
+            if history.dirty:
+                self._evicted[user_id] = history
+            else:
+                self._add_cold(user_id, history)
+
+    def _add_cold(self, user_id: int, history: TelegamUserHistory):
+        self._cold[user_id] = history
+        if not history.compressed:
+            self._uncompressed[user_id] = history
+        while len(self._cold) > self._cold_size:
+            user_id, history = self._cold.popitem(last=False)
+            self._uncompressed.pop(user_id, None)
+            if history.dirty:
+                self._evicted[user_id] = history
+
+    def keep(self, history: TelegamUserHistory):
+        """Flush a history changed by a task that held it while it was dropped from the cold tier.
+
+        Histories still in a tier are flushed anyway. A newer copy loaded for the user meanwhile
+        wins, the change to the dropped one is not written over it.
+        """
+        user_id = history.user_id
+        current = (self._histories.get(user_id) or self._cold.get(user_id)
+                   or self._evicted.get(user_id) or self._writing.get(user_id))
+        if current is None and history.dirty:
+            self._evicted[user_id] = history
+
+    async def compress_idle(self):
+        """Move histories idle for compress_after seconds to the cold tier and compress it in a worker thread"""
+        async with self._flush_lock:
+            cutoff = time.monotonic() - self._compress_after
+            for user_id, history in list(self._histories.items()):
+                # the LRU order is the order of use, the first recent history ends the idle ones
+                if history.last_used > cutoff:
+                    break
+                if not history.dirty:
+                    del self._histories[user_id]
+                    self._add_cold(user_id, history)
+            # a cold history read by a task still holding it is inflated in place, it is packed again
+            for user_id, history in self._cold.items():
+                if not history.compressed:
+                    self._uncompressed[user_id] = history
+            pending = [(history, history.generation, history.messages_count)
+                       for history in self._uncompressed.values() if not history.dirty]
+            self._uncompressed = {user_id: history for user_id, history in self._uncompressed.items() if history.dirty}
+            if not pending:
+                return
+            packed = await asyncio.to_thread(lambda: [history.pack() for history, _, _ in pending])
+            for (history, generation, messages_count), data in zip(pending, packed):
+                # a history taken back meanwhile stays as it is
+                if self._cold.get(history.user_id) is history:
+                    history.set_packed(data, generation, messages_count)
+
+    async def start(self):
+        if self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flush_loop())
+
+    async def stop(self):
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            try:
+                await self._flush_task
+            except asyncio.CancelledError:
+                pass
+            self._flush_task = None
+        await self.flush()
+        await asyncio.to_thread(self._backend.close)
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self._flush_interval)
+            try:
+                await self.flush()
+                await self.compress_idle()
+            except Exception as e:
+                print("Error flushing user histories: ", e)
+
+    async def flush(self):
+        async with self._flush_lock:
+            dirty = [history for history in self._histories.values() if history.dirty]
+            dirty.extend(self._evicted.values())
+            # a cold history still referenced by a running task can change after it left the LRU
+            dirty.extend(history for history in self._cold.values() if history.dirty)
+            # evicted histories stay reachable until written, so a returning user never reads a stale file
+            self._writing, self._evicted = self._evicted, {}
+            if not dirty:
+                return
+            snapshots = [(history.user_id, history.user_name, history.take_snapshot()) for history in dirty]
+            failed = {history.user_id for history in dirty}
+            try:
+                with HISTORY_FLUSH.time():
+                    failed = set(await asyncio.to_thread(self._write_batch, snapshots))
+                HISTORIES_FLUSHED.inc(len(snapshots) - len(failed))
+            finally:
+                # histories not written are dirty again and retried in full on the next flush
+                for history in dirty:
+                    if history.user_id in failed:
+                        history.mark_unsaved()
+                writing, self._writing = self._writing, {}
+                for user_id, history in writing.items():
+                    if self._histories.get(user_id) is history:
+                        continue
+                    if history.dirty:
+                        self._evicted[user_id] = history
+                    else:
+                        # written evicted histories stay warm in the cold tier unless their user came back
+                        self._add_cold(user_id, history)
+
+    def _write_batch(self, snapshots: list) -> list:
+        batch = [(user_id, user_name, *TelegamUserHistory.to_entries(snapshot)) for user_id, user_name, snapshot in snapshots]
+        return self._backend.write_batch(batch)
+
+    async def get_stats(self, message: Message) -> tuple:
+        """Return (messages_count, tokens_count) for the user, asking the backend when the history is not loaded"""
+        user_id = message.from_user.id
+        history = (self._histories.get(user_id) or self._cold.get(user_id)
+                   or self._evicted.get(user_id) or self._writing.get(user_id))
+        if history is None:
+            stats = await asyncio.to_thread(self._backend.stats, user_id)
+            if stats is not None:
+                return stats
+            history = await self.get_history(message)
+        return history.messages_count, history.tokens_count
+
+    def set_token_counter(self, token_counter):
+        self._token_counter = token_counter
+        for history in self._histories.values():
+            history.set_token_counter(token_counter)
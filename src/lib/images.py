@@ -0,0 +1,96 @@
+import base64
+import io
+import math
+
+# Pillow is imported inside the functions, only processes that handle photos pay for it
+
+VISION_MAX_SIDE = 2048
+VISION_SHORT_SIDE = 768
+VISION_LOW_SIDE = 512
+VISION_TILE_SIZE = 512
+VISION_BASE_TOKENS = 85
+VISION_TILE_TOKENS = 170
+JPEG_QUALITY = 85
+
+
+def vision_size(width: int, height: int, detail: str = 'high') -> tuple:
+    """Size the model scales an image to before billing it, images are never scaled up"""
+    if detail == 'low':
+        scale = min(1.0, VISION_LOW_SIDE / max(width, height))
+    else:
+        # fit into 2048x2048, then bring the short side down to 768
+        scale = min(1.0, VISION_MAX_SIDE / max(width, height))
+        scale *= min(1.0, VISION_SHORT_SIDE / (min(width, height) * scale))
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+
+def count_vision_tokens(width: int, height: int, detail: str = 'high') -> int:
+    """Tokens billed for an image: a base cost plus 170 per 512px tile of the scaled image"""
+    if detail == 'low':
+        return VISION_BASE_TOKENS
+    width, height = vision_size(width, height, detail)
+    tiles = math.ceil(width / VISION_TILE_SIZE) * math.ceil(height / VISION_TILE_SIZE)
+    return VISION_BASE_TOKENS + VISION_TILE_TOKENS * tiles
+
+
+def pick_photo_size(photos, detail: str = 'high'):
+    """Smallest PhotoSize that still covers the size the model bills for, or the largest one"""
+    ordered = sorted(photos, key=lambda photo: photo.width * photo.height)
+    for photo in ordered:
+        if detail == 'low':
+            covers = max(photo.width, photo.height) >= VISION_LOW_SIDE
+        else:
+            covers = min(photo.width, photo.height) >= VISION_SHORT_SIDE or max(photo.width, photo.height) >= VISION_MAX_SIDE
+        if covers:
+            return photo
+    return ordered[-1]
+
+
+def _open_image(data: bytes, size_for):
+    """Open an image decoded at the smallest scale that still covers size_for(width, height), rotated by EXIF"""
+    from PIL import Image, ImageOps
+
+    image = Image.open(io.BytesIO(data))
+    # JPEG decoding at a reduced scale keeps large photos from ever being decoded in full,
+    # the target does not depend on the orientation so it is right before the EXIF rotation too
+    image.draft('RGB', size_for(*image.size))
+    return ImageOps.exif_transpose(image)
+
+
+def prepare_vision_image(data: bytes, detail: str = 'high') -> tuple:
+    """Downscale an image to the size the model bills for and re-encode it as JPEG.
+
+    Blocking, meant to run in a worker thread. Returns (jpeg_bytes, width, height).
+    """
+    from PIL import Image
+
+    image = _open_image(data, lambda width, height: vision_size(width, height, detail))
+    target = vision_size(*image.size, detail)
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+    if image.size != target:
+        image = image.resize(target, Image.LANCZOS)
+    output = io.BytesIO()
+    image.save(output, format='JPEG', quality=JPEG_QUALITY, optimize=True)
+    return output.getvalue(), image.width, image.height
+
+
+def prepare_edit_image(data: bytes, width: int, height: int) -> tuple:
+    """Center-crop an image to the edit size aspect, resize it and encode as RGBA PNG as the edit API expects.
+
+    The edit endpoint only changes transparent areas, so a fully transparent mask of the
+    same size is returned with it to let the whole image be edited. Returns (image_png, mask_png).
+    """
+    from PIL import Image, ImageOps
+
+    image = _open_image(data, lambda *_: (width, height))
+    image = ImageOps.fit(image.convert('RGBA'), (width, height), Image.LANCZOS)
+    output = io.BytesIO()
+    image.save(output, format='PNG', optimize=True)
+    mask = io.BytesIO()
+    Image.new('RGBA', (width, height), (0, 0, 0, 0)).save(mask, format='PNG', optimize=True)
+    return output.getvalue(), mask.getvalue()
+
+
+def to_data_url(data: bytes, mime_type: str = 'image/jpeg') -> str:
+    return f'data:{mime_type};base64,' + base64.b64encode(data).decode()
@@ -0,0 +1,321 @@
+import asyncio
+import bisect
+import sys
+import threading
+import time
+import traceback
+from collections import Counter as StackCounter, deque
+
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def _format_labels(labelnames: tuple, values: tuple) -> str:
+    if not labelnames:
+        return ''
+    pairs = ','.join(f'{name}="{str(value)}"' for name, value in zip(labelnames, values))
+    return '{' + pairs + '}'
+
+
+class _Metric:
+
+    type_name = ''
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(labels.get(name, '') for name in self.labelnames)
+
+    def render(self) -> list:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.type_name}']
+        lines.extend(self._samples())
+        return lines
+
+    def _samples(self) -> list:
+        raise NotImplementedError
+
+
+class _ValueMetric(_Metric):
+    """Metric with one value per label set, values can also come from a callback returning
+    {labels tuple: value} when the metrics are rendered"""
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = (), callback=None):
+        super().__init__(name, documentation, labelnames)
+        self._values = {}
+        self._callback = callback
+
+    def get(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0)
+
+    def values(self) -> dict:
+        return dict(self._values)
+
+    def _samples(self) -> list:
+        values = dict(self._values)
+        if self._callback is not None:
+            try:
+                values.update(self._callback())
+            except Exception as e:
+                print(f"Error collecting metric {self.name}: ", e)
+        return [f'{self.name}{_format_labels(self.labelnames, key)} {value}' for key, value in values.items()]
+
+
+class Counter(_ValueMetric):
+
+    type_name = 'counter'
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_ValueMetric):
+
+    type_name = 'gauge'
+
+    def set(self, value: float, **labels):
+        self._values[self._key(labels)] = value
+
+
+class Histogram(_Metric):
+
+    type_name = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self._buckets = tuple(sorted(buckets))
+        self._series = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        series = self._series.get(key)
+        if series is None:
+            series = [[0] * (len(self._buckets) + 1), 0.0, 0]
+            self._series[key] = series
+        series[0][bisect.bisect_left(self._buckets, value)] += 1
+        series[1] += value
+        series[2] += 1
+
+    def time(self, **labels):
+        return _Timer(self, labels)
+
+    def quantile(self, fraction: float, **labels) -> float:
+        """Upper bound of the bucket holding the quantile, good enough for /stats"""
+        series = self._series.get(self._key(labels))
+        if series is None or series[2] == 0:
+            return 0.0
+        rank = fraction * series[2]
+        seen = 0
+        for index, count in enumerate(series[0]):
+            seen += count
+            if seen >= rank:
+                return self._buckets[index] if index < len(self._buckets) else float('inf')
+        return float('inf')
+
+    def series(self) -> dict:
+        return {key: (series[2], series[1]) for key, series in self._series.items()}
+
+    def _samples(self) -> list:
+        lines = []
+        for key, (counts, total, count) in self._series.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self._buckets + (float('inf'),), counts):
+                cumulative += bucket_count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                labels = _format_labels(self.labelnames + ('le',), key + (le,))
+                lines.append(f'{self.name}_bucket{labels} {cumulative}')
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f'{self.name}_sum{labels} {total}')
+            lines.append(f'{self.name}_count{labels} {count}')
+        return lines
+
+
+class _Timer:
+
+    def __init__(self, histogram: Histogram, labels: dict):
+        self._histogram = histogram
+        self._labels = labels
+        self._started = None
+
+    def __enter__(self):
+        self._started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._histogram.observe(time.perf_counter() - self._started, **self._labels)
+        return False
+
+
+class MetricsRegistry:
+    """Process-wide metrics in the Prometheus text format, metrics are created on first use by name"""
+
+    def __init__(self):
+        self._metrics = {}
+
+    def _get_or_create(self, cls, name: str, *args, callback=None, **kwargs):
+        metric = self._metrics.get(name)
+        if metric is None:
+            metric = cls(name, *args, **kwargs) if callback is None else cls(name, *args, callback=callback, **kwargs)
+            self._metrics[name] = metric
+        elif callback is not None:
+            # the latest owner of a callback metric reports it, e.g. a bot rebuilt in the same process
+            metric._callback = callback
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames: tuple = (), callback=None) -> Counter:
+        return self._get_or_create(Counter, name, documentation, labelnames, callback=callback)
+
+    def gauge(self, name: str, documentation: str, labelnames: tuple = (), callback=None) -> Gauge:
+        return self._get_or_create(Gauge, name, documentation, labelnames, callback=callback)
+
+    def histogram(self, name: str, documentation: str, labelnames: tuple = (), buckets: tuple = DEFAULT_BUCKETS) -> Histogram:
+        return self._get_or_create(Histogram, name, documentation, labelnames, buckets=buckets)
+
+    def get(self, name: str):
+        return self._metrics.get(name)
+
+    def render(self) -> str:
+        lines = []
+        for metric in list(self._metrics.values()):
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = MetricsRegistry()
+
+
+class StartupTimer:
+    """Durations of the startup phases, exported as startup_phase_seconds and printed as one line"""
+
+    def __init__(self, started: float = None, registry: MetricsRegistry = REGISTRY):
+        self._started = started if started is not None else time.perf_counter()
+        self._last = self._started
+        self._gauge = registry.gauge('startup_phase_seconds', 'Duration of startup phases', ('phase',))
+        self.phases = []
+
+    def mark(self, phase: str):
+        """End the current phase, it started when the previous one ended"""
+        now = time.perf_counter()
+        self.phases.append((phase, now - self._last))
+        self._gauge.set(now - self._last, phase=phase)
+        self._last = now
+
+    def report(self) -> str:
+        total = self._last - self._started
+        self._gauge.set(total, phase='total')
+        return "Startup: " + ", ".join(f"{phase} {seconds:.2f}s" for phase, seconds in self.phases) + f", total {total:.2f}s"
+
+
+class LoopLagMonitor:
+    """Measures how late the event loop wakes up a sleeping task, every lag is also appended to samples if given"""
+
+    INTERVAL = 0.1
+
+    def __init__(self, registry: MetricsRegistry = REGISTRY, interval: float = None, samples: list = None):
+        self._histogram = registry.histogram(
+            'event_loop_lag_seconds', 'Delay of event loop wake-ups',
+            buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 5),
+        )
+        self._interval = interval or self.INTERVAL
+        self._samples = samples
+        self._task = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            started = loop.time()
+            await asyncio.sleep(self._interval)
+            lag = max(0.0, loop.time() - started - self._interval)
+            self._histogram.observe(lag)
+            if self._samples is not None:
+                self._samples.append(lag)
+
+
+class SlowUpdateProfiler:
+    """Opt-in sampling profiler of the event loop thread.
+
+    While updates are in flight a daemon thread samples the loop thread's stack every
+    interval seconds. When an update takes longer than threshold seconds, the stacks
+    sampled during it are aggregated and the hottest ones are printed. A threshold of
+    None keeps it disabled, it can be changed at runtime.
+    """
+
+    MAX_SAMPLES = 20000
+    TOP_STACKS = 5
+    STACK_DEPTH = 12
+
+    def __init__(self, threshold: float = None, interval: float = 0.005):
+        self.threshold = threshold
+        self._interval = interval
+        self._samples = deque(maxlen=self.MAX_SAMPLES)
+        self._active = 0
+        self._thread_id = None
+        self._thread = None
+        self._wakeup = threading.Event()
+
+    def set_threshold(self, threshold: float | None):
+        self.threshold = threshold
+        if threshold is None:
+            self._samples.clear()
+
+    def begin(self) -> float | None:
+        """Mark the start of an update on the loop thread, returns a token for end()"""
+        if self.threshold is None:
+            return None
+        if self._thread is None:
+            self._thread_id = threading.get_ident()
+            self._thread = threading.Thread(target=self._run, name='slow-update-profiler', daemon=True)
+            self._thread.start()
+        self._active += 1
+        self._wakeup.set()
+        return time.monotonic()
+
+    def end(self, started: float | None, name: str):
+        if started is None:
+            return
+        self._active -= 1
+        if self._active <= 0:
+            self._active = 0
+            self._wakeup.clear()
+        finished = time.monotonic()
+        if self.threshold is None or finished - started < self.threshold:
+            return
+        stacks = StackCounter(stack for at, stack in list(self._samples) if started <= at <= finished)
+        if not stacks:
+            return
+        total = sum(stacks.values())
+        lines = [f"Slow update in {name}: {finished - started:.2f}s, {total} samples"]
+        for stack, count in stacks.most_common(self.TOP_STACKS):
+            lines.append(f"  {count * 100 / total:.0f}% of samples:")
+            lines.extend(f"    {frame}" for frame in stack)
+        print("\n".join(lines), file=sys.stderr)
+
+    def _run(self):
+        while True:
+            self._wakeup.wait()
+            frame = sys._current_frames().get(self._thread_id)
+            # a loop waiting in select() is idle, only the time it spends running code is interesting
+            if frame is not None and not frame.f_code.co_filename.endswith('selectors.py'):
+                stack = tuple(
+                    f"{summary.filename}:{summary.lineno} {summary.name}"
+                    for summary in traceback.extract_stack(frame)[-self.STACK_DEPTH:]
+                )
+                self._samples.append((time.monotonic(), stack))
+            del frame
+            time.sleep(self._interval)
@@ -0,0 +1,30 @@
+from .telegram_history import TelegamUserHistory
+
+
+class PromptAssembler:
+    """Builds chat prompts in one fixed order so consecutive requests share the longest prefix.
+
+    Providers serve the leading tokens of a prompt from their cache when they repeat byte for
+    byte. Every prompt starts with the same system prompt, then the conversation summary (it
+    changes only when the history is summarized), then the turns, which only grow at the end
+    until the history window has to slide. The summary request reuses the prefix of the last
+    chat request and only appends the instruction to it.
+    """
+
+    SUMMARY_INSTRUCTION = "Обобщи этот разговор не более чем в 700 символах или меньше."
+
+    def __init__(self, system_prompt: str = None, token_counter=None):
+        self._system = [{"role": "system", "content": system_prompt}] if system_prompt else []
+        self.system_tokens = sum(token_counter(message) for message in self._system) if token_counter else 0
+
+    def private(self, history: TelegamUserHistory, budget: int) -> tuple:
+        """(messages, prompt tokens) of a private chat request, the history window fits into budget"""
+        budget -= self.system_tokens
+        window = history.get_window(budget)
+        return self._system + window, self.system_tokens + min(history.tokens_count, budget)
+
+    def group(self, thread: list) -> list:
+        return self._system + thread
+
+    def summary(self, storage: list) -> list:
+        return self._system + storage + [{"role": "user", "content": self.SUMMARY_INSTRUCTION}]
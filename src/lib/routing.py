@@ -0,0 +1,160 @@
+import asyncio
+import os
+import re
+import signal
+
+from .configuration import YamlConfiguration
+
+
+class RoutingTable:
+    """Triggers and access lists built from telegram_settings, never changed once built.
+
+    The trigger regexes are combined into one alternation per message kind, so a message is
+    matched in a single pass and the first trigger in priority order wins, as with checking
+    them one by one. Access lists are kept as sets of ids, usernames and titles. A reload
+    builds a new table and swaps it in with one assignment.
+    """
+
+    # priority order of the triggers
+    GROUP_TRIGGERS = ('image_vision', 'image_change', 'image', 'chat')
+    IMAGE_TRIGGERS = ('image_vision', 'image_change', 'image')
+
+    def __init__(self, configuration):
+        self.triggers = {
+            'chat': re.compile(configuration.chat_trigger_regex),
+            'image': re.compile(configuration.image_trigger_regex),
+            'image_change': re.compile(configuration.image_change_trigger_regex),
+            'image_vision': re.compile(configuration.image_vision_trigger_regex),
+        }
+        self._group_dispatch = self._combine(self.GROUP_TRIGGERS)
+        self._image_dispatch = self._combine(self.IMAGE_TRIGGERS)
+        self._group_whitelist = self._as_set(configuration.white_lists_groups)
+        self._group_blacklist = self._as_set(configuration.black_lists_groups)
+        if self._group_whitelist is not None and self._group_blacklist is not None:
+            print("Warning: groups whitelist is defined, and group blacklist is defined. Blacklist will be ignored")
+            self._group_blacklist = None
+        self._private_whitelist = self._as_set(configuration.white_lists_persons)
+        self._private_blacklist = self._as_set(configuration.black_lists_persons)
+        if self._private_whitelist is not None and self._private_blacklist is not None:
+            print("Warning: persons whitelist is defined, and persons blacklist is defined. Blacklist will be ignored")
+            self._private_blacklist = None
+        self._admins = self._as_set(getattr(configuration, 'admin_users', None)) or frozenset()
+
+    @staticmethod
+    def _as_set(values) -> frozenset | None:
+        if values is None:
+            return None
+        return frozenset(values)
+
+    def _combine(self, names: tuple):
+        """One regex with a named group per trigger, or None to check them one by one"""
+        try:
+            return re.compile('|'.join(f'(?P<{name}>{self.triggers[name].pattern})' for name in names))
+        except re.error as e:
+            # e.g. inline global flags are only allowed at the start of the whole pattern
+            print("Warning: trigger regexes can not be combined, they are checked one by one: ", e)
+            return None
+
+    def _dispatch(self, dispatch, names: tuple, text: str) -> str | None:
+        if dispatch is None:
+            return next((name for name in names if self.triggers[name].match(text)), None)
+        match = dispatch.match(text)
+        if match is None:
+            return None
+        return next(name for name in names if match.start(name) != -1)
+
+    def match_group_trigger(self, text: str) -> str | None:
+        """Name of the trigger a group message starts with"""
+        return self._dispatch(self._group_dispatch, self.GROUP_TRIGGERS, text)
+
+    def match_image_trigger(self, text: str) -> str | None:
+        """Name of the image trigger a private message or a photo caption starts with"""
+        return self._dispatch(self._image_dispatch, self.IMAGE_TRIGGERS, text)
+
+    def group_has_access(self, chat_id: int, title: str) -> bool:
+        if self._group_whitelist is not None:
+            return chat_id in self._group_whitelist or title in self._group_whitelist
+        if self._group_blacklist is not None:
+            return chat_id not in self._group_blacklist and title not in self._group_blacklist
+        return True
+
+    def person_has_access(self, user_id: int, username: str) -> bool:
+        if self._private_whitelist is not None:
+            return username in self._private_whitelist or user_id in self._private_whitelist
+        if self._private_blacklist is not None:
+            return username not in self._private_blacklist and user_id not in self._private_blacklist
+        return True
+
+    def is_admin(self, user_id: int, username: str) -> bool:
+        return username in self._admins or user_id in self._admins
+
+
+class ConfigWatcher:
+    """Reloads the YAML configuration when the file changes or the process gets SIGHUP.
+
+    Reading, parsing and build(config) run in a worker thread, apply(result) is then called
+    on the event loop. A configuration that fails to load or build is reported and the
+    current one stays in use.
+    """
+
+    DEFAULT_INTERVAL = 5
+
+    def __init__(self, config_file: str, work_folder: str, build, apply, interval: float = None, sighup=True):
+        self._config_file = config_file
+        self._work_folder = work_folder
+        self._build = build
+        self._apply = apply
+        self._interval = interval or self.DEFAULT_INTERVAL
+        self._sighup = sighup
+        self._mtime = None
+        self._reload_requested = None
+        self._task = None
+
+    async def start(self):
+        self._mtime = await asyncio.to_thread(self._get_mtime)
+        self._reload_requested = asyncio.Event()
+        if self._sighup:
+            asyncio.get_running_loop().add_signal_handler(signal.SIGHUP, self._reload_requested.set)
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        if self._sighup:
+            asyncio.get_running_loop().remove_signal_handler(signal.SIGHUP)
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._reload_requested.wait(), self._interval)
+            except asyncio.TimeoutError:
+                pass
+            forced = self._reload_requested.is_set()
+            self._reload_requested.clear()
+            try:
+                mtime = await asyncio.to_thread(self._get_mtime)
+                if forced or mtime != self._mtime:
+                    self._mtime = mtime
+                    await self.reload()
+            except Exception as e:
+                print("Error reloading configuration: ", e)
+
+    async def reload(self):
+        result = await asyncio.to_thread(self._load)
+        self._apply(result)
+        print(f"Configuration reloaded from {self._config_file}")
+
+    def _get_mtime(self) -> float | None:
+        try:
+            return os.stat(self._config_file).st_mtime
+        except FileNotFoundError:
+            return None
+
+    def _load(self):
+        return self._build(YamlConfiguration(self._config_file, self._work_folder).load())
@@ -0,0 +1,198 @@
+import asyncio
+import time
+from collections import deque
+from typing import Awaitable, Callable, List
+
+from telegram.error import BadRequest, NetworkError, RetryAfter, TimedOut
+
+
+def _bounded_lines(text: str, limit: int):
+    for line in text.splitlines(keepends=True):
+        while len(line) > limit:
+            yield line[:limit]
+            line = line[limit:]
+        yield line
+
+
+def split_message(text: str, limit: int) -> List[str]:
+    """Split text into parts of at most limit characters in one pass over its lines.
+
+    Parts end on paragraph boundaries when possible, otherwise on line boundaries. A code
+    block cut between parts is closed with ``` and reopened in the next part.
+    """
+    if len(text) <= limit:
+        return [text]
+    # room for closing a code block at the end of a part
+    budget = limit - 4
+    parts = []
+    lines = []
+    size = 0
+    paragraph_end = 0
+    fence = None
+    for line in _bounded_lines(text, budget // 2):
+        while lines and size + len(line) > budget:
+            cut = paragraph_end or len(lines)
+            open_fence = None if paragraph_end else fence
+            part = ''.join(lines[:cut]).rstrip('\n')
+            lines = lines[cut:]
+            if open_fence is not None:
+                part += '\n```'
+                lines.insert(0, open_fence + '\n')
+            parts.append(part)
+            size = sum(len(rest) for rest in lines)
+            paragraph_end = 0
+        lines.append(line)
+        size += len(line)
+        stripped = line.strip()
+        if stripped.startswith('```'):
+            fence = None if fence is not None else stripped
+        elif not stripped and fence is None:
+            paragraph_end = len(lines)
+    if lines:
+        parts.append(''.join(lines).rstrip('\n'))
+    return [part for part in parts if part.strip()]
+
+
+class TokenBucket:
+
+    def __init__(self, rate: float, capacity: float):
+        self._rate = rate
+        self._capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self._capacity, self._tokens + (now - self._updated) * self._rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self._rate)
+
+    @property
+    def ready(self) -> bool:
+        return self._tokens + (time.monotonic() - self._updated) * self._rate >= 1
+
+    @property
+    def idle(self) -> bool:
+        return self._tokens + (time.monotonic() - self._updated) * self._rate >= self._capacity
+
+
+class TelegramSendQueue:
+    """Outbound scheduler for Bot API calls with Telegram flood limits in mind.
+
+    Calls go through a global token bucket and a per-chat one (groups get a lower rate).
+    The parts of one reply are sent back to back without interleaving with other replies
+    to the same chat, RetryAfter waits the time Telegram asks for and transient network
+    errors are retried with backoff.
+    """
+
+    DEFAULT_GLOBAL_RATE = 30
+    DEFAULT_CHAT_RATE = 1
+    DEFAULT_GROUP_RATE = 20 / 60
+    CHAT_BURST = 3
+    MAX_RETRIES = 3
+    LATENCY_SAMPLES = 1024
+
+    def __init__(self, global_rate: float = None, chat_rate: float = None, group_rate: float = None):
+        global_rate = global_rate or self.DEFAULT_GLOBAL_RATE
+        self._global_bucket = TokenBucket(global_rate, global_rate)
+        self._chat_rate = chat_rate or self.DEFAULT_CHAT_RATE
+        self._group_rate = group_rate or self.DEFAULT_GROUP_RATE
+        self._chat_buckets = {}
+        self._chat_locks = {}
+        self._pending = 0
+        self._latencies = deque(maxlen=self.LATENCY_SAMPLES)
+        self.sent = 0
+        self.retries = 0
+        self.failed = 0
+
+    async def submit(self, chat_id: int, *calls: Callable[[], Awaitable]) -> list:
+        """Run the calls in order for chat_id within the rate limits, returns their results"""
+        started = time.monotonic()
+        results = []
+        self._pending += len(calls)
+        lock = self._chat_locks.setdefault(chat_id, [asyncio.Lock(), 0])
+        lock[1] += 1
+        try:
+            async with lock[0]:
+                for call in calls:
+                    results.append(await self._send(chat_id, call))
+                    self._pending -= 1
+            return results
+        finally:
+            self._pending -= len(calls) - len(results)
+            lock[1] -= 1
+            if lock[1] == 0:
+                self._chat_locks.pop(chat_id, None)
+                bucket = self._chat_buckets.get(chat_id)
+                if bucket is not None and bucket.idle:
+                    del self._chat_buckets[chat_id]
+            self._latencies.append(time.monotonic() - started)
+
+    async def send_text(self, message, parts: List[str]) -> list:
+        """Reply to message with every part, as one job so the parts stay together"""
+        return await self.submit(message.chat_id, *[lambda part=part: message.reply_text(part) for part in parts])
+
+    def is_busy(self, chat_id: int) -> bool:
+        """True if a call for chat_id would have to wait, used to skip optional updates like stream edits"""
+        bucket = self._chat_buckets.get(chat_id)
+        return chat_id in self._chat_locks or (bucket is not None and not bucket.ready)
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            rate = self._group_rate if chat_id < 0 else self._chat_rate
+            bucket = TokenBucket(rate, self.CHAT_BURST)
+            self._chat_buckets[chat_id] = bucket
+        return bucket
+
+    async def _send(self, chat_id: int, call: Callable[[], Awaitable]):
+        attempt = 0
+        while True:
+            await self._chat_bucket(chat_id).acquire()
+            await self._global_bucket.acquire()
+            try:
+                result = await call()
+                self.sent += 1
+                return result
+            except BadRequest:
+                self.failed += 1
+                raise
+            except RetryAfter as e:
+                if attempt >= self.MAX_RETRIES:
+                    self.failed += 1
+                    raise
+                delay = e.retry_after
+                if hasattr(delay, 'total_seconds'):
+                    delay = delay.total_seconds()
+            except (TimedOut, NetworkError):
+                if attempt >= self.MAX_RETRIES:
+                    self.failed += 1
+                    raise
+                delay = 2 ** attempt
+            attempt += 1
+            self.retries += 1
+            await asyncio.sleep(delay)
+
+    def stats(self) -> dict:
+        latencies = sorted(self._latencies)
+
+        def percentile(fraction):
+            if not latencies:
+                return 0.0
+            return latencies[min(len(latencies) - 1, int(fraction * len(latencies)))]
+
+        return {
+            "queue_depth": self._pending,
+            "active_chats": len(self._chat_locks),
+            "sent": self.sent,
+            "retries": self.retries,
+            "failed": self.failed,
+            "latency_p50": percentile(0.5),
+            "latency_p95": percentile(0.95),
+        }
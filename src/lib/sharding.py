@@ -0,0 +1,217 @@
+import asyncio
+import bisect
+import hashlib
+import multiprocessing
+import os
+import signal
+
+from telegram import Update
+from telegram.ext import Application, TypeHandler
+
+from .configuration import YamlConfiguration
+from .metrics import StartupTimer
+from .webhook import MetricsServer, WebhookServer
+
+
+class HashRing:
+    """Consistent hash of chat ids onto shards, adding a shard moves only ~1/n of the chats"""
+
+    def __init__(self, shards: int, replicas: int = 160):
+        self._ring = []
+        for shard in range(shards):
+            for replica in range(replicas):
+                self._ring.append((self._hash(f'{shard}:{replica}'), shard))
+        self._ring.sort()
+        self._keys = [point for point, _ in self._ring]
+
+    @staticmethod
+    def _hash(value: str) -> int:
+        return int.from_bytes(hashlib.md5(value.encode()).digest()[:8], 'big')
+
+    def get(self, key) -> int:
+        index = bisect.bisect(self._keys, self._hash(str(key))) % len(self._keys)
+        return self._ring[index][1]
+
+
+def shard_path(path: str, index: int) -> str:
+    """path with the shard index before its extension, e.g. admission.json -> admission.2.json"""
+    root, ext = os.path.splitext(path)
+    return f'{root}.{index}{ext}'
+
+
+def run_shard_worker(index: int, updates: multiprocessing.Queue, config, config_file: str = None, work_folder: str = None):
+    """Entry point of a worker process: handles the updates routed to its shard until it gets None"""
+    timer = StartupTimer()
+    # imported here so the front process does not load the AI stack
+    from .ai import OpenAI
+    from .telegram import TelegramBot
+    timer.mark('bot imports')
+
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    settings = config.telegram_settings
+    # every worker saves its own state, budgets and group context only cover the chats of its shard
+    admission_state_file = getattr(settings, 'admission_state_file', None) or os.path.join(settings.logs_dir, 'admission.json')
+    settings.admission_state_file = shard_path(admission_state_file, index)
+    if getattr(settings, 'group_context_state_file', None):
+        settings.group_context_state_file = shard_path(settings.group_context_state_file, index)
+    open_ai = OpenAI(configuration=config.ai_settings)
+    telegram_bot = TelegramBot(configuration=config.telegram_settings)
+    telegram_bot.set_ai_handler(open_ai)
+    if config_file:
+        # SIGHUP belongs to the front process, workers notice config changes by the file time
+        telegram_bot.watch_config(config_file, work_folder, sighup=False)
+    timer.mark('init')
+    open_ai.warm_up()
+    timer.mark('warm-up')
+    print(f"Shard worker {index} {timer.report()}")
+    if telegram_bot.metrics_port:
+        # metrics are per process, worker i listens next to the front process port
+        telegram_bot.metrics_port += index + 1
+    application = telegram_bot.build_application()
+    asyncio.run(_serve_shard(index, application, updates))
+
+
+async def _serve_shard(index: int, application: Application, updates: multiprocessing.Queue):
+    await application.initialize()
+    if application.post_init:
+        await application.post_init(application)
+    await application.start()
+    print(f"Shard worker {index} started, pid {os.getpid()}")
+    try:
+        while True:
+            data = await asyncio.to_thread(updates.get)
+            if data is None:
+                break
+            update = Update.de_json(data, application.bot)
+            if update is not None:
+                await application.update_queue.put(update)
+    finally:
+        # stop() handles the updates already queued, so a draining worker finishes its work
+        await application.stop()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
+        await application.shutdown()
+        print(f"Shard worker {index} stopped")
+
+
+class ShardedTelegramBot:
+    """Front process receiving updates and routing them to worker processes by chat id.
+
+    Every chat is always handled by the same worker, so user histories have a single owner
+    and need no cross-process locking. Workers that die are restarted on the same queue,
+    SIGHUP reloads the configuration and restarts all workers one by one after they drained
+    their queued updates.
+    """
+
+    WATCH_INTERVAL = 1.0
+    STOP_TIMEOUT = 60
+
+    def __init__(self, configuration, workers: int, token=None, config_file: str = None, work_folder: str = None):
+        if token is None:
+            token = os.environ.get("telegram_token", None)
+        if token is None:
+            raise ValueError("Telegram token is not defined")
+        self._config = configuration
+        self._config_file = config_file
+        self._work_folder = work_folder
+        self._token = token
+        self._ring = HashRing(workers)
+        self._context = multiprocessing.get_context('spawn')
+        self._queues = [self._context.Queue() for _ in range(workers)]
+        self._processes = [None] * workers
+        self._restarting = set()
+        self._stopping = False
+        self._watch_task = None
+        self._metrics_server = None
+
+    def run(self):
+        application = Application.builder().token(self._token)\
+            .post_init(self._post_init).post_shutdown(self._post_shutdown).build()
+        application.add_handler(TypeHandler(Update, self._route_update))
+        mode = getattr(self._config.telegram_settings, 'mode', None) or 'polling'
+        if mode == 'webhook':
+            WebhookServer(application, self._config.telegram_settings).run()
+            return
+        application.run_polling()
+
+    def _start_worker(self, index: int):
+        process = self._context.Process(
+            target=run_shard_worker, args=(index, self._queues[index], self._config, self._config_file, self._work_folder),
+            name=f'shard-{index}', daemon=False
+        )
+        process.start()
+        self._processes[index] = process
+
+    async def _stop_worker(self, index: int):
+        process = self._processes[index]
+        if process is None:
+            return
+        if process.is_alive():
+            self._queues[index].put(None)
+            await asyncio.to_thread(process.join, self.STOP_TIMEOUT)
+            if process.is_alive():
+                process.terminate()
+                await asyncio.to_thread(process.join)
+        self._processes[index] = None
+
+    async def restart_worker(self, index: int):
+        """Drain and restart one worker, updates routed meanwhile wait in its queue"""
+        self._restarting.add(index)
+        try:
+            await self._stop_worker(index)
+            if not self._stopping:
+                self._start_worker(index)
+        finally:
+            self._restarting.discard(index)
+
+    async def restart_all(self):
+        if self._config_file:
+            try:
+                await self._reload_config()
+            except Exception as e:
+                print("Error reloading configuration, workers restart with the current one: ", e)
+        for index in range(len(self._processes)):
+            await self.restart_worker(index)
+
+    async def _reload_config(self):
+        config = await asyncio.to_thread(YamlConfiguration(self._config_file, self._work_folder).load)
+        if not config.telegram_settings.logs_dir:
+            config.telegram_settings.logs_dir = self._config.telegram_settings.logs_dir
+        self._config = config
+
+    async def _route_update(self, update: Update, context):
+        key = None
+        if update.effective_chat is not None:
+            key = update.effective_chat.id
+        elif update.effective_user is not None:
+            key = update.effective_user.id
+        index = self._ring.get(key if key is not None else update.update_id)
+        self._queues[index].put(update.to_dict())
+
+    async def _post_init(self, application):
+        for index in range(len(self._processes)):
+            self._start_worker(index)
+        loop = asyncio.get_running_loop()
+        loop.add_signal_handler(signal.SIGHUP, lambda: asyncio.ensure_future(self.restart_all()))
+        self._watch_task = asyncio.create_task(self._watch_workers())
+        metrics_port = getattr(self._config.telegram_settings, 'metrics_port', None)
+        if metrics_port:
+            self._metrics_server = MetricsServer(metrics_port, getattr(self._config.telegram_settings, 'metrics_listen', None))
+            self._metrics_server.start()
+
+    async def _watch_workers(self):
+        while not self._stopping:
+            await asyncio.sleep(self.WATCH_INTERVAL)
+            for index, process in enumerate(self._processes):
+                if index in self._restarting or process is None or process.is_alive():
+                    continue
+                print(f"Shard worker {index} exited with code {process.exitcode}, restarting")
+                self._start_worker(index)
+
+    async def _post_shutdown(self, application):
+        self._stopping = True
+        if self._watch_task is not None:
+            self._watch_task.cancel()
+        await asyncio.gather(*(self._stop_worker(index) for index in range(len(self._processes))))
+        if self._metrics_server is not None:
+            await self._metrics_server.stop()
@@ -1,17 +1,33 @@
 import asyncio
+import contextlib
+import functools
 import os
-import re
-from io import BytesIO
-from typing import List
-from PIL import Image
+import time
+from typing import AsyncIterator, List
 
-
-from pydub import AudioSegment
 from telegram import Message
+from telegram.error import BadRequest
 from telegram.ext import Application, MessageHandler, filters, CommandHandler
 from telegram.constants import ChatType
 
+from .admission import AdmissionController
+from .audio import SpeechPipeline, VoicePipeline
+from .concurrency import ChatUpdateProcessor
+from .errors import AdmissionException
+from .group_context import GroupContextStore
+from .history_backends import create_history_backend
+from .history_store import TelegramHistoryStore
+from .images import count_vision_tokens, pick_photo_size, prepare_edit_image, prepare_vision_image, to_data_url
+from .metrics import REGISTRY, LoopLagMonitor, SlowUpdateProfiler
+from .prompt import PromptAssembler
+from .routing import ConfigWatcher, RoutingTable
+from .sender import TelegramSendQueue, split_message
 from .telegram_history import TelegamUserHistory
+from .webhook import MetricsServer, WebhookServer
+
+
+HANDLER_LATENCY = REGISTRY.histogram('bot_handler_seconds', 'Time spent in update handlers', ('handler',))
+HANDLER_ERRORS = REGISTRY.counter('bot_handler_errors_total', 'Update handlers that raised', ('handler',))
 
 
 class TelegramBot:
@@ -28,57 +44,166 @@ class TelegramBot:
         self._config = configuration
         self._token = token
         self._ai_handler = None
+        self._prompts = PromptAssembler()
         self._logs_dir = configuration.logs_dir
-        self._groups_blacklist = configuration.black_lists_groups
-        self._group_whitelist = configuration.white_lists_groups
-        self._check_group_whitelist = True if self._group_whitelist is not None else False
-        self._check_group_blacklist = True if self._groups_blacklist is not None and not self._check_group_whitelist else False
-        if self._group_whitelist is not None and self._groups_blacklist is not None:
-            print("Warning: groups whitelist is defined, and group blacklist is defined. Blacklist will be ignored")
-        self._private_blacklist = configuration.black_lists_persons
-        self._private_whitelist = configuration.white_lists_persons
-        self._check_private_whitelist = True if self._private_whitelist is not None else False
-        self._check_private_blacklist = True if self._private_blacklist is not None and not self._check_private_whitelist else False
-        if self._private_whitelist is not None and self._private_blacklist is not None:
-            print("Warning: persons whitelist is defined, and persons blacklist is defined. Blacklist will be ignored")
-        self._chat_trigger_regex = re.compile(configuration.chat_trigger_regex)
-        self._image_trigger_regex = re.compile(configuration.image_trigger_regex)
-        self._image_change_trigger_regex = re.compile(configuration.image_change_trigger_regex)
-        self._image_vision_trigger_regex = re.compile(configuration.image_vision_trigger_regex)
-        self._triggers_check = [
-            [self._image_trigger_regex, self._image_create_process],
-            [self._chat_trigger_regex, self._text_group_chat_message_process],
-        ]
-
-        self._images_triggers = [
-            [self._image_vision_trigger_regex, self._image_vision_process],
-            [self._image_change_trigger_regex, self._image_change_process],
-            [self._image_trigger_regex, self._image_create_process],
-        ]
-
-        self._private_chats_gistory = {}
+        # triggers and access lists, replaced as a whole when the configuration is reloaded
+        self._routing = RoutingTable(configuration)
+        self._config_watcher = None
+        self._summary_tasks = {}
+        self._admission = AdmissionController(
+            configuration,
+            state_file=getattr(configuration, 'admission_state_file', None) or os.path.join(self._logs_dir, 'admission.json'),
+        )
+        self._sender = TelegramSendQueue(
+            global_rate=getattr(configuration, 'send_global_rate', None),
+            chat_rate=getattr(configuration, 'send_chat_rate', None),
+            group_rate=getattr(configuration, 'send_group_rate', None),
+        )
+        self._voice_pipeline = VoicePipeline(transcode_workers=getattr(configuration, 'voice_transcode_workers', None))
+        self._speech_pipeline = None
+        self._voice_replies = bool(getattr(configuration, 'voice_replies', False))
+        self._stream_responses = bool(getattr(configuration, 'stream_responses', False))
+        self._stream_edit_interval = getattr(configuration, 'stream_edit_interval', None) or 1.5
+        self._profiler = SlowUpdateProfiler(getattr(configuration, 'profile_slow_updates', None))
+        self._loop_lag = LoopLagMonitor()
+        self.metrics_port = getattr(configuration, 'metrics_port', None)
+        self._metrics_server = None
+        REGISTRY.gauge(
+            'telegram_send_queue', 'Outbound Bot API calls', ('state',),
+            callback=lambda: {(key,): value for key, value in self._sender.stats().items() if not key.startswith('latency')},
+        )
+        REGISTRY.gauge(
+            'admission_requests', 'LLM requests by admission result', ('state',),
+            callback=lambda: {(key,): value for key, value in self._admission.stats().items()},
+        )
+        self._trigger_handlers = {
+            'image_vision': self._image_vision_process,
+            'image_change': self._image_change_process,
+            'image': self._image_create_process,
+            'chat': self._text_group_chat_message_process,
+        }
+
+        self._group_context = GroupContextStore(configuration, getattr(configuration, 'group_context_state_file', None))
+        REGISTRY.gauge(
+            'group_context', 'Groups and tokens held in the group context', ('state',),
+            callback=lambda: {(key,): value for key, value in self._group_context.stats().items()},
+        )
+        self._history_store = TelegramHistoryStore(
+            create_history_backend(configuration),
+            cache_size=getattr(configuration, 'history_cache_size', None),
+            flush_interval=getattr(configuration, 'history_flush_interval', None),
+            compress_after=getattr(configuration, 'history_compress_after', None),
+            cold_size=getattr(configuration, 'history_cold_size', None),
+        )
 
     def set_ai_handler(self, ai_handler):
         self._ai_handler = ai_handler
+        self._prompts = PromptAssembler(ai_handler.get_system_prompt(), ai_handler.count_message_tokens)
+        self._speech_pipeline = SpeechPipeline(
+            ai_handler.text_to_voice,
+            segment_chars=getattr(self._config, 'speech_segment_chars', None),
+            first_segment_chars=getattr(self._config, 'speech_first_segment_chars', None),
+            concurrency=getattr(self._config, 'speech_concurrency', None),
+        )
+        self._history_store.set_token_counter(ai_handler.count_message_tokens)
+        self._group_context.set_token_counter(ai_handler.count_message_tokens)
+        REGISTRY.gauge(
+            'openai_circuit_open', 'OpenAI endpoints with an open circuit breaker', ('endpoint',),
+            callback=lambda: {
+                (endpoint,): int(state != 'closed') for endpoint, state in ai_handler.get_api_stats()["circuits"].items()
+            },
+        )
+
+    def watch_config(self, config_file: str, work_folder: str, sighup=True):
+        """Reload triggers and access lists when config_file changes (and on SIGHUP if sighup), once the bot runs"""
+        self._config_watcher = ConfigWatcher(
+            config_file, work_folder,
+            build=lambda config: RoutingTable(config.telegram_settings),
+            apply=self._set_routing,
+            interval=getattr(self._config, 'config_reload_interval', None),
+            sighup=sighup,
+        )
+
+    def _set_routing(self, routing: RoutingTable):
+        self._routing = routing
 
     def start_telegram_bot(self):
-        application = Application.builder().token(self._token).build()
-        application.add_handler(CommandHandler('reset', self.reset_private_history, filters=filters.ChatType.PRIVATE))
-        application.add_handler(CommandHandler('summ', self.summary_private_history, filters=filters.ChatType.PRIVATE))
-        application.add_handler(CommandHandler('help', self.help_private_chat, filters=filters.ChatType.PRIVATE))
-        application.add_handler(CommandHandler('info', self.info_private_chat, filters=filters.ChatType.PRIVATE))
-        application.add_handler(CommandHandler('image', self._image_create_process_from_cmd, filters=filters.ChatType.PRIVATE | filters.ChatType.GROUP | filters.ChatType.SUPERGROUP))
-        application.add_handler(MessageHandler(filters.ChatType.GROUP, self.group_messages_handler))
-        application.add_handler(MessageHandler(filters.ChatType.SUPERGROUP, self.group_messages_handler))
-        application.add_handler(MessageHandler(filters.ChatType.PRIVATE, self.private_chat_handler))
+        application = self.build_application()
+        mode = getattr(self._config, 'mode', None) or 'polling'
+        if mode == 'webhook':
+            WebhookServer(application, self._config).run()
+            return
+        if mode != 'polling':
+            raise ValueError(f'Unknown telegram bot mode: {mode}')
         application.run_polling()
 
+    def build_application(self, builder=None) -> Application:
+        """Build the application with all handlers registered, builder allows overriding e.g. the Bot API url"""
+        if builder is None:
+            builder = Application.builder()
+        update_processor = ChatUpdateProcessor(
+            concurrent_updates=getattr(self._config, 'concurrent_updates', None),
+            fast_lane_updates=getattr(self._config, 'fast_lane_updates', None),
+        )
+        application = builder.token(self._token).concurrent_updates(update_processor)\
+            .post_init(self._post_init).post_shutdown(self._post_shutdown).build()
+        application.add_handler(CommandHandler('reset', self._instrument('reset', self.reset_private_history), filters=filters.ChatType.PRIVATE))
+        application.add_handler(CommandHandler('summ', self._instrument('summ', self.summary_private_history), filters=filters.ChatType.PRIVATE))
+        application.add_handler(CommandHandler('help', self._instrument('help', self.help_private_chat), filters=filters.ChatType.PRIVATE))
+        application.add_handler(CommandHandler('info', self._instrument('info', self.info_private_chat), filters=filters.ChatType.PRIVATE))
+        application.add_handler(CommandHandler('stats', self._instrument('stats', self.stats_private_chat), filters=filters.ChatType.PRIVATE))
+        application.add_handler(CommandHandler('profile', self._instrument('profile', self.profile_private_chat), filters=filters.ChatType.PRIVATE))
+        application.add_handler(CommandHandler('image', self._instrument('image', self._image_create_process_from_cmd), filters=filters.ChatType.PRIVATE | filters.ChatType.GROUP | filters.ChatType.SUPERGROUP))
+        application.add_handler(MessageHandler(filters.ChatType.GROUP, self._instrument('group', self.group_messages_handler)))
+        application.add_handler(MessageHandler(filters.ChatType.SUPERGROUP, self._instrument('group', self.group_messages_handler)))
+        application.add_handler(MessageHandler(filters.ChatType.PRIVATE, self._instrument('private', self.private_chat_handler)))
+        return application
+
+    def _instrument(self, name: str, handler):
+        """Wrap a handler to record its latency and errors, slow runs are reported by the profiler when enabled"""
+        @functools.wraps(handler)
+        async def wrapper(update, context):
+            token = self._profiler.begin()
+            started = time.perf_counter()
+            try:
+                return await handler(update, context)
+            except Exception:
+                HANDLER_ERRORS.inc(handler=name)
+                raise
+            finally:
+                HANDLER_LATENCY.observe(time.perf_counter() - started, handler=name)
+                self._profiler.end(token, name)
+        return wrapper
+
+    async def _post_init(self, application):
+        await self._history_store.start()
+        await self._admission.start()
+        await self._group_context.start()
+        self._loop_lag.start()
+        if self._config_watcher is not None:
+            await self._config_watcher.start()
+        if self.metrics_port:
+            self._metrics_server = MetricsServer(self.metrics_port, getattr(self._config, 'metrics_listen', None))
+            self._metrics_server.start()
+
+    async def _post_shutdown(self, application):
+        for task in list(self._summary_tasks.values()):
+            task.cancel()
+        if self._config_watcher is not None:
+            await self._config_watcher.stop()
+        await self._history_store.stop()
+        await self._admission.stop()
+        await self._group_context.stop()
+        await self._loop_lag.stop()
+        if self._metrics_server is not None:
+            await self._metrics_server.stop()
+
     async def reset_private_history(self, update, context):
         message = update.message
         private_chat = message.chat.type == ChatType.PRIVATE
         if not private_chat:
             return
-        user_history = TelegamUserHistory.get_history(message, self._logs_dir)
+        user_history = await self._history_store.get_history(message)
         await user_history.clear_history()
         await self._send_message(message, "Диалог сброшен.")
 
@@ -92,17 +217,75 @@ class TelegramBot:
 
     async def info_private_chat(self, update, context):
         message = update.message
-        user_history = TelegamUserHistory.get_history(message, self._logs_dir)
-        storage = user_history.get_storage()
-        messages_count = len(storage)
-        tokens_count = 0 if messages_count == 0 else self._ai_handler.count_tokens(storage)
+        messages_count, tokens_count = await self._history_store.get_stats(message)
         info_text = f"Количество сообщений: {messages_count}\nКоличество токенов: {tokens_count}"
         await self._send_message(message, info_text)
 
+    async def stats_private_chat(self, update, context):
+        message = update.message
+        if not self._is_admin(message):
+            return
+        await self._send_message(message, self._format_stats())
+
+    async def profile_private_chat(self, update, context):
+        """/profile <seconds> reports stacks of updates slower than that, /profile off disables it"""
+        message = update.message
+        if not self._is_admin(message):
+            return
+        if context.args:
+            argument = context.args[0].lower()
+            try:
+                self._profiler.set_threshold(None if argument == 'off' else float(argument))
+            except ValueError:
+                return await self._send_message(message, "Использование: /profile <секунды> или /profile off")
+        threshold = self._profiler.threshold
+        state = "выключен" if threshold is None else f"отчеты об обновлениях дольше {threshold} с"
+        await self._send_message(message, f"Профилировщик: {state}")
+
+    def _format_stats(self) -> str:
+        lines = ["Обработчики (кол-во, p50, p95):"]
+        for (name,), (count, _) in sorted(HANDLER_LATENCY.series().items()):
+            lines.append(f"  {name}: {count}, {HANDLER_LATENCY.quantile(0.5, handler=name)}s, "
+                         f"{HANDLER_LATENCY.quantile(0.95, handler=name)}s, ошибок {HANDLER_ERRORS.get(handler=name)}")
+        request_latency = REGISTRY.get('openai_request_seconds')
+        if request_latency is not None:
+            lines.append("OpenAI (кол-во, p50, p95):")
+            for (endpoint,), (count, _) in sorted(request_latency.series().items()):
+                lines.append(f"  {endpoint}: {count}, {request_latency.quantile(0.5, endpoint=endpoint)}s, "
+                             f"{request_latency.quantile(0.95, endpoint=endpoint)}s")
+        tokens = REGISTRY.get('openai_tokens_total')
+        if tokens is not None:
+            prompt = sum(value for (_, kind), value in tokens.values().items() if kind == 'prompt')
+            completion = sum(value for (_, kind), value in tokens.values().items() if kind == 'completion')
+            lines.append(f"Токены: запрос {prompt}, ответ {completion}")
+        if self._ai_handler is not None:
+            cache = self._ai_handler.cache.stats()
+            lookups = cache["hits"] + cache["misses"]
+            hit_rate = cache["hits"] * 100 / lookups if lookups else 0
+            lines.append(f"Кэш: попаданий {cache['hits']} из {lookups} ({hit_rate:.0f}%), записей {cache['entries']}")
+            api_stats = self._ai_handler.get_api_stats()
+            lines.append(f"Цепи OpenAI: {api_stats['circuits']}")
+            lines.append(f"Объединено одинаковых запросов: {api_stats['single_flight']['coalesced']} "
+                         f"на {api_stats['single_flight']['calls']} вызовов")
+            prompt_cache = api_stats['prompt_cache']
+            lines.append(f"Кэш промптов: {prompt_cache['cached_tokens']} из {prompt_cache['prompt_tokens']} токенов "
+                         f"({prompt_cache['hit_ratio'] * 100:.0f}%)")
+        sender = self._sender.stats()
+        lines.append(f"Отправка: очередь {sender['queue_depth']}, отправлено {sender['sent']}, "
+                     f"повторов {sender['retries']}, ошибок {sender['failed']}, p95 {sender['latency_p95']:.2f}s")
+        admission = self._admission.stats()
+        lines.append(f"Допуск: принято {admission['admitted']}, отклонено {admission['rejected']}, "
+                     f"сброшено {admission['shed']}, в очереди {admission['waiting']}")
+        loop_lag = REGISTRY.get('event_loop_lag_seconds')
+        lines.append(f"Задержка event loop p95: {loop_lag.quantile(0.95)}s")
+        threshold = self._profiler.threshold
+        lines.append("Профилировщик: " + ("выключен" if threshold is None else f"порог {threshold} с"))
+        return "\n".join(lines)
+
     async def summary_private_history(self, update, context):
         message = update.message
-        user_history = TelegamUserHistory.get_history(message, self._logs_dir)
-        if len(user_history.get_storage()) == 0:
+        user_history = await self._history_store.get_history(message)
+        if user_history.messages_count == 0:
             return await self._send_message(message, "Нет сообщений в контексте.")
         await self._summarize_if_need(message, user_history, hard_reset=True)
 
@@ -110,12 +293,12 @@ class TelegramBot:
         message = update.message
         if not await self._check_is_valid_private_chat_update(message):
             return
-        user_history = TelegamUserHistory.get_history(message, self._logs_dir)
+        user_history = await self._history_store.get_history(message)
         if message.voice:
             transcript = await self._get_voice_message_as_text(message, context)
             if transcript is None:
                 return
-            await self._handle_text_message(message, transcript, user_history)
+            await self._handle_text_message(message, transcript, user_history, voice_reply=self._voice_replies)
             return
         stop = await self._check_and_handle_image_intent(message, context, user_history)
         if stop:
@@ -123,29 +306,35 @@ class TelegramBot:
         if message.text and len(message.text) > 0:
             await self._handle_text_message(message, message.text, user_history)
 
-    async def _handle_text_message(self, message, text, user_history):
+    async def _handle_text_message(self, message, text, user_history, voice_reply=False):
         is_bot = self._is_message_from_bot(message)
         user_history.add_to_history(text, is_bot=is_bot)
         await self._summarize_if_need(message, user_history)
         if is_bot:
             return
         generated_message = await self._text_private_chat_message_process(message, user_history)
-        if generated_message is not None:
+        if generated_message:
             user_history.add_to_history(generated_message, is_bot=True)
+            self._admission.add_tokens(message.from_user.id, message.chat.id, user_history.last_tokens)
             await self._summarize_if_need(message, user_history)
+            if voice_reply:
+                await self._send_voice_reply(message, generated_message)
         return
 
     async def group_messages_handler(self, update, context):
         message = update.message
         if not self._group_has_access(message):
             return await self._send_message(message, "You are not allowed to use this bot. Maybe you are crab or in past life you did something very very bad :).  Call @logrusak for help.")
+        self._record_group_message(message)
         if not message.text:
+            if message.photo and message.caption:
+                await self._check_and_handle_image_intent(message, context, None)
             return
         text_message = message.text.lower()
-        for regex, handler in self._triggers_check:
-            if regex.match(text_message):
-                await handler(message, text_message)
-                return
+        trigger = self._routing.match_group_trigger(text_message)
+        if trigger is not None:
+            await self._trigger_handlers[trigger](message, text_message)
+            return
         if self._is_message_reply_to_bot(message):
             reply = message.reply_to_message
             is_replay_image = reply.photo is not None and len(reply.photo) > 0
@@ -155,14 +344,24 @@ class TelegramBot:
             await self._text_group_chat_message_process(message, text_message)
             return
 
+    def _record_group_message(self, message):
+        if message.from_user is None:
+            return
+        reply_to = message.reply_to_message.message_id if message.reply_to_message is not None else None
+        role = "assistant" if self._is_message_from_bot(message) else "user"
+        name = message.from_user.username if role == "user" else None
+        self._group_context.record(message.chat.id, message.message_id, reply_to, role, message.text or message.caption, name)
+
     async def _check_and_handle_image_intent(self, message, context, user_history) -> bool:
-        if message.photo is None:
+        text = message.caption if message.photo else message.text
+        if not text:
             return False
-        for regex, handler in self._images_triggers:
-            if regex.match(message.text):
-                await handler(message, message.text)
-                return True
-        return False
+        text = text.lower()
+        trigger = self._routing.match_image_trigger(text)
+        if trigger is None:
+            return False
+        await self._trigger_handlers[trigger](message, text)
+        return True
 
     async def _check_is_valid_private_chat_update(self, message) -> bool:
         if not self._is_message_for_handle(message):
@@ -173,47 +372,118 @@ class TelegramBot:
         return True
 
     async def _summarize_if_need(self, message: Message, user_history: TelegamUserHistory, hard_reset=False):
+        """Start a background summary when the history is over the token limit, only one per user at a time"""
         if not hard_reset:
-            tokens_len = self._ai_handler.count_tokens(user_history.get_storage())
-            if not self._ai_handler.needs_summarization(tokens_len):
+            if not self._ai_handler.needs_summarization(user_history.tokens_count):
                 return
-        messages = [
-            {"role": "assistant", "content": "Обобщи этот разговор не более чем в 700 символах или меньше."},
-            {"role": "user", "content": str(user_history.get_storage())}
-        ]
+        task = self._summary_tasks.get(user_history.user_id)
+        if task is None:
+            task = asyncio.create_task(self._summarize_history(message, user_history))
+            self._summary_tasks[user_history.user_id] = task
+            task.add_done_callback(functools.partial(self._summary_done, user_history.user_id))
+        if hard_reset:
+            await asyncio.shield(task)
+
+    def _summary_done(self, user_id: int, task: asyncio.Task):
+        self._summary_tasks.pop(user_id, None)
+        if not task.cancelled() and task.exception() is not None:
+            print(f"Error summarizing history for user {user_id}: ", task.exception())
+
+    async def _summarize_history(self, message: Message, user_history: TelegamUserHistory):
+        storage = user_history.get_storage()
+        count = len(storage)
+        generation = user_history.generation
+        # the conversation itself, not a transcript of it, so the request starts with the cached chat prefix
+        messages = self._prompts.summary(storage[:count])
         response_text, error = await self._ai_handler.get_chat_message_response(messages, user_history.user_id)
         if error is not None:
-            return await self._send_message(message, "Ошибка при обобщении диалога:" + error)
-        await user_history.summary_history(response_text)
+            return await self._send_message(message, "Ошибка при обобщении диалога:" + str(error))
+        if not response_text or user_history.generation != generation:
+            return
+        user_history.replace_prefix(count, response_text)
+        # the history may have left the cache while the summary was generated: evicted and cold
+        # histories are flushed when dirty, one dropped from the cold tier is handed back here
+        self._history_store.keep(user_history)
         await self._send_message(message, "Достигнут лимит токенов. Диалог обобщен.")
 
     async def _text_private_chat_message_process(self, message: Message, history: TelegamUserHistory) -> str:
         user_id = message.from_user.id
-        storage = history.get_storage()
-        response_text, error = await self._ai_handler.get_chat_message_response(storage, user_id)
+        # while a summary is pending the prompt is the most recent part of the history that fits the budget
+        messages, prompt_tokens = self._prompts.private(history, self._ai_handler.get_context_budget())
+        response_text, error = await self._reply_with_chat_response(message, messages, user_id, prompt_tokens=prompt_tokens)
         if error is not None:
-            return await self._send_message(message, "Ошибка при отправке сообщения:" + str(error))
-        if response_text is not None:
-            await self._send_message(message, response_text)
-            history.add_to_history(response_text, is_bot=True)
-            return response_text
-        return None
+            await self._send_message(message, "Ошибка при отправке сообщения:" + str(error))
+            return None
+        return response_text
+
+    async def _reply_with_chat_response(self, message: Message, messages: list, user_id: int, use_cache=False, prompt_tokens=0,
+                                        sent_messages: list = None):
+        """Generate a completion for messages and send it as a reply, streamed if enabled.
+
+        The request has to pass admission control first, a rejected one gets a polite reply
+        and returns (None, None). A (message, text) pair of every sent reply part is appended to
+        sent_messages if given.
+        """
+        try:
+            async with self._admission.admit(user_id, message.chat.id, prompt_tokens):
+                return await self._generate_chat_reply(message, messages, user_id, use_cache, sent_messages)
+        except AdmissionException as e:
+            await self._send_admission_reply(message, e)
+            return None, None
+
+    async def _send_admission_reply(self, message: Message, error: AdmissionException):
+        if error.reason == "budget":
+            minutes = max(1, int(error.retry_after // 60) + 1)
+            return await self._send_message(message, f"Лимит запросов исчерпан, попробуйте через {minutes} мин.")
+        await self._send_message(message, "Бот сейчас перегружен, попробуйте немного позже.")
+
+    async def _generate_chat_reply(self, message: Message, messages: list, user_id: int, use_cache=False, sent_messages: list = None):
+        if not self._stream_responses:
+            response_text, error = await self._ai_handler.get_chat_message_response(messages, user_id, use_cache=use_cache)
+            if error is None and response_text is not None:
+                sent = await self._send_message(message, response_text)
+                if sent_messages is not None:
+                    sent_messages.extend(zip(sent, self._check_message_len(response_text)))
+            return response_text, error
+        try:
+            response_text = await self._send_streaming_message(
+                message, self._ai_handler.get_chat_message_stream(messages, user_id, use_cache=use_cache), sent_messages
+            )
+        except Exception as e:
+            return None, e
+        return response_text, None
 
     async def _text_group_chat_message_process(self, message, check_text):
         data_to_send = []
         reply_to_message = message.reply_to_message
         if reply_to_message is not None:
-            reply_message = message.reply_to_message
-            if self._is_message_for_handle(reply_message):
-                role = "assistant" if self._is_message_from_bot(reply_message) else "user"
-                data_to_send.append({"role": role, "content": reply_message.text})
+            # the whole reply thread when the group context still has it, otherwise just the replied message
+            data_to_send, _ = self._group_context.get_thread(
+                message.chat.id, reply_to_message.message_id, self._ai_handler.get_context_budget() - self._prompts.system_tokens
+            )
+            if not data_to_send and self._is_message_for_handle(reply_to_message):
+                role = "assistant" if self._is_message_from_bot(reply_to_message) else "user"
+                data_to_send.append({"role": role, "content": reply_to_message.text})
         data_to_send.append({"role": "user", "content": check_text})
+        data_to_send = self._prompts.group(data_to_send)
         user_id = message.from_user.id
-        response_text, error = await self._ai_handler.get_chat_message_response(data_to_send, user_id)
+        sent_messages = []
+        # groups repeat the same trigger phrases, identical prompts are answered from the cache
+        response_text, error = await self._reply_with_chat_response(
+            message, data_to_send, user_id, use_cache=True, prompt_tokens=self._ai_handler.count_tokens(data_to_send),
+            sent_messages=sent_messages,
+        )
         if error is not None:
-            return await self._send_message(message, "Ошибка при обработке сообщения:" + error)
-        if response_text is not None:
-            await self._send_message(message, response_text)
+            return await self._send_message(message, "Ошибка при обработке сообщения:" + str(error))
+        if response_text:
+            # every part holds its own text and replies to the part before it, a thread from any part has the reply once
+            reply_to = message.message_id
+            for sent, text in sent_messages:
+                self._group_context.record(message.chat.id, sent.message_id, reply_to, "assistant", text)
+                reply_to = sent.message_id
+            self._admission.add_tokens(user_id, message.chat.id, self._ai_handler.count_message_tokens(
+                {"role": "assistant", "content": response_text}
+            ))
 
     async def _image_create_process_from_cmd(self, update, context):
         message = update.message
@@ -221,29 +491,96 @@ class TelegramBot:
         await self._image_create_process(message, text)
 
     async def _image_create_process(self, message, generation_text):
-        normalized_text = re.sub(self._image_trigger_regex, "", generation_text)
+        normalized_text = self._routing.triggers['image'].sub("", generation_text)
         normalized_text = normalized_text.strip()
-        response_text, error = await self._ai_handler.get_image_create_response(normalized_text)
+        cache_key = self._ai_handler.get_image_cache_key(normalized_text)
+        file_id = await self._ai_handler.cache.get_file_id(cache_key)
+        if file_id is not None:
+            await self._send_photo(message, file_id)
+            return
+        try:
+            async with self._admission.admit(message.from_user.id, message.chat.id):
+                response_text, error = await self._ai_handler.get_image_create_response(normalized_text)
+        except AdmissionException as e:
+            return await self._send_admission_reply(message, e)
         if error is not None:
-            return await self._send_message(message, "Ошибка при создании картинки:" + error)
+            return await self._send_message(message, "Ошибка при создании картинки:" + str(error))
         if response_text is not None:
             if response_text.startswith("http"):
-                await message.reply_photo(response_text)
+                sent = await self._send_photo(message, response_text)
+                if sent.photo:
+                    await self._ai_handler.cache.set_file_id(cache_key, sent.photo[-1].file_id)
                 return
             await self._send_message(message, response_text)
 
     async def _image_vision_process(self, message, check_text):
-        normalized_text = re.sub(self._image_trigger_regex, "", check_text)
-        normalized_text = normalized_text.strip()
-        response_text = await self._ai_handler.get_image_create_response(normalized_text)
-        if response_text is not None:
-            if response_text.startswith("http"):
-                await message.reply_photo(response_text)
-                return
-            await self._send_message(message, response_text)
+        photos = self._get_message_photos(message)
+        if not photos:
+            return await self._send_message(message, "Прикрепите картинку или ответьте на сообщение с картинкой.")
+        prompt = self._routing.triggers['image_vision'].sub("", check_text).strip() or "Опиши это изображение."
+        detail = self._ai_handler.get_vision_detail()
+        try:
+            data = await self._download_photo(pick_photo_size(photos, detail))
+            image, width, height = await asyncio.to_thread(prepare_vision_image, data, detail)
+        except Exception as e:
+            print("Error preparing image for vision: ", e)
+            return await self._send_message(message, "Ошибка при обработке картинки:" + str(e))
+        messages = [{"role": "user", "content": [
+            {"type": "text", "text": prompt},
+            {"type": "image_url", "image_url": {"url": to_data_url(image), "detail": detail}},
+        ]}]
+        # the image is counted by the size it was scaled to, the data url is not decoded again
+        prompt_tokens = self._ai_handler.count_tokens([{"role": "user", "content": prompt}]) + count_vision_tokens(width, height, detail)
+        response_text, error = await self._reply_with_chat_response(
+            message, messages, message.from_user.id, prompt_tokens=prompt_tokens
+        )
+        if error is not None:
+            return await self._send_message(message, "Ошибка при описании картинки:" + str(error))
+        if response_text:
+            self._admission.add_tokens(message.from_user.id, message.chat.id, self._ai_handler.count_message_tokens(
+                {"role": "assistant", "content": response_text}
+            ))
 
     async def _image_change_process(self, message, check_text):
-        return
+        photos = self._get_message_photos(message)
+        if not photos:
+            return await self._send_message(message, "Прикрепите картинку или ответьте на сообщение с картинкой.")
+        prompt = self._routing.triggers['image_change'].sub("", check_text).strip()
+        if not prompt:
+            return await self._send_message(message, "Опишите, что нужно изменить на картинке.")
+        sizes = {photo.file_id: {'w': photo.width, 'h': photo.height} for photo in photos}
+        file_id, width, height = self._ai_handler.get_image_to_change(sizes)
+        photo = next(photo for photo in photos if photo.file_id == file_id)
+        try:
+            data = await self._download_photo(photo)
+            image, mask = await asyncio.to_thread(prepare_edit_image, data, width, height)
+        except Exception as e:
+            print("Error preparing image for edit: ", e)
+            return await self._send_message(message, "Ошибка при обработке картинки:" + str(e))
+        try:
+            async with self._admission.admit(message.from_user.id, message.chat.id):
+                response_text, error = await self._ai_handler.get_image_edit_response(image, mask, prompt)
+        except AdmissionException as e:
+            return await self._send_admission_reply(message, e)
+        if error is not None:
+            return await self._send_message(message, "Ошибка при изменении картинки:" + str(error))
+        if response_text is not None:
+            await self._send_photo(message, response_text)
+
+    @staticmethod
+    def _get_message_photos(message) -> tuple:
+        """Sizes of the photo in the message itself or in the message it replies to"""
+        if message.photo:
+            return message.photo
+        reply = message.reply_to_message
+        if reply is not None and reply.photo:
+            return reply.photo
+        return ()
+
+    @staticmethod
+    async def _download_photo(photo) -> bytes:
+        media_file = await photo.get_file()
+        return bytes(await media_file.download_as_bytearray())
 
     def _is_message_for_handle(self, message) -> bool:
         """Check if message have text, from_user and chat attributes for processing"""
@@ -273,64 +610,101 @@ class TelegramBot:
         return False
 
     def _group_has_access(self, message):
-        if self._check_group_whitelist:
-            return message.chat.id in self._group_whitelist or message.chat.title in self._group_whitelist
-        if self._check_group_blacklist:
-            return message.chat.id not in self._groups_blacklist and message.chat.title not in self._groups_blacklist
-        return True
+        return self._routing.group_has_access(message.chat.id, message.chat.title)
+
+    def _is_admin(self, message) -> bool:
+        return self._routing.is_admin(message.from_user.id, message.from_user.username)
 
     def _person_has_access(self, message) -> bool:
-        if self._check_private_whitelist:
-            return message.from_user.username in self._private_whitelist or message.from_user.id in self._private_whitelist
-        if self._check_private_blacklist:
-            return message.from_user.username not in self._private_blacklist and message.from_user.id not in self._private_blacklist
-        return True
+        return self._routing.person_has_access(message.from_user.id, message.from_user.username)
 
-    async def _send_message(self, message, text: str):
+    async def _send_message(self, message, text: str) -> list:
         parts = self._check_message_len(text)
-        for text_part in parts:
-            await message.reply_text(text_part)
+        return await self._sender.send_text(message, parts)
+
+    async def _send_photo(self, message, photo):
+        sent = await self._sender.submit(message.chat_id, lambda: message.reply_photo(photo))
+        return sent[0]
+
+    async def _send_voice_reply(self, message, text: str):
+        """Send text as voice messages in order, each one as soon as it is synthesized"""
+        try:
+            # closed right away on an error, so the segments still being synthesized are cancelled
+            async with contextlib.aclosing(self._speech_pipeline.synthesize(text)) as segments:
+                async for audio in segments:
+                    # bytes instead of the stream, a retried send uploads the whole voice again
+                    data = audio.getvalue()
+                    await self._sender.submit(message.chat_id, lambda data=data: message.reply_voice(data))
+        except Exception as e:
+            print("Error sending voice reply: ", e)
+
+    async def _send_streaming_message(self, message, chunks: AsyncIterator[str], sent_messages: list = None) -> str:
+        """Reply with the first chunk at once and keep editing the reply as the rest arrives.
+
+        Edits are throttled to one per stream_edit_interval seconds, text past
+        TELEGRAMM_MAX_MESSAGE_LENGTH continues in a new reply. Returns the full text,
+        a (message, text) pair of every reply is appended to sent_messages if given.
+        """
+        created = []
+
+        async def update(sent, text: str, final=False):
+            updated = await self._update_streaming_message(message, sent, text, final)
+            if sent is None and updated is not None:
+                created.append(updated)
+            return updated
+
+        loop = asyncio.get_running_loop()
+        parts = []
+        current = ''
+        shown = ''
+        sent = None
+        last_edit = 0.0
+        async for chunk in chunks:
+            parts.append(chunk)
+            current += chunk
+            while len(current) > self.TELEGRAMM_MAX_MESSAGE_LENGTH:
+                head = current[:self.TELEGRAMM_MAX_MESSAGE_LENGTH]
+                current = current[self.TELEGRAMM_MAX_MESSAGE_LENGTH:]
+                await update(sent, head, final=True)
+                sent, shown = None, ''
+            now = loop.time()
+            if current.strip() and current != shown and (sent is None or now - last_edit >= self._stream_edit_interval):
+                updated = await update(sent, current)
+                if updated is not None:
+                    sent, shown, last_edit = updated, current, now
+        if current.strip() and current != shown:
+            await update(sent, current, final=True)
+        text = ''.join(parts)
+        if sent_messages is not None:
+            # the replies hold consecutive TELEGRAMM_MAX_MESSAGE_LENGTH slices of the text
+            step = self.TELEGRAMM_MAX_MESSAGE_LENGTH
+            sent_messages.extend(zip(created, [text[i:i + step] for i in range(0, len(text), step)]))
+        return text
+
+    async def _update_streaming_message(self, message, sent, text: str, final=False):
+        """Send or edit the streamed reply, returns the sent message or None if the update was skipped"""
+        try:
+            if sent is None:
+                return (await self._sender.submit(message.chat_id, lambda: message.reply_text(text)))[0]
+            if not final and self._sender.is_busy(message.chat_id):
+                return None
+            await self._sender.submit(message.chat_id, lambda: sent.edit_text(text))
+            return sent
+        except BadRequest as e:
+            if 'not modified' in str(e).lower():
+                return sent
+            raise
 
     def _check_message_len(self, message: str) -> List[str]:
-        count = len(message)
-        messages = []
-        if count > self.TELEGRAMM_MAX_MESSAGE_LENGTH:
-            while len(message) > self.TELEGRAMM_MAX_MESSAGE_LENGTH:
-                part = message[:self.TELEGRAMM_MAX_MESSAGE_LENGTH]
-                messages.append(part)
-                message = message[self.TELEGRAMM_MAX_MESSAGE_LENGTH:]
-            if len(message) > 0:
-                messages.append(message)
-        else:
-            messages.append(message)
-        return messages
+        return split_message(message, self.TELEGRAMM_MAX_MESSAGE_LENGTH)
 
     async def _get_voice_message_as_text(self, message: Message, context):
-        filename = message.effective_attachment.file_unique_id
-        filename_mp3 = f'/tmp/{filename}.mp3'
         try:
-            media_file = await context.bot.get_file(message.effective_attachment.file_id)
-            await media_file.download_to_drive(filename)
+            audio = await self._voice_pipeline.get_transcription_file(context.bot, message.effective_attachment)
         except Exception as e:
             print("Error downloading voice message: ", e)
             return
-        try:
-            audio_track = AudioSegment.from_file(filename)
-            audio_track.export(filename_mp3, format="mp3")
-        except Exception as err:
-            print(err)
-        if await asyncio.to_thread(os.path.exists, filename):
-            await asyncio.to_thread(os.remove, filename)
-        transcript, error = await self._ai_handler.transcribe_voice_message(filename_mp3)
+        transcript, error = await self._ai_handler.transcribe_voice_message(audio)
         if error is not None:
-            return await self._send_message(message, "Ошибка при обработке голосового сообщения:" + error)
-        if await asyncio.to_thread(os.path.exists, filename_mp3):
-            await asyncio.to_thread(os.remove, filename_mp3)
+            return await self._send_message(message, "Ошибка при обработке голосового сообщения:" + str(error))
         return transcript
-
-
-
-
-
-
-
@@ -1,50 +1,223 @@
-import asyncio
 import json
-import os
+import zlib
+
+from .history_backends import BaseHistoryBackend
+
+# role names are kept once per process, messages store their index
+ROLES = ["system", "user", "assistant"]
+ROLE_CODES = {role: code for code, role in enumerate(ROLES)}
+
+
+def role_code(role: str) -> int:
+    code = ROLE_CODES.get(role)
+    if code is None:
+        ROLES.append(role)
+        code = ROLE_CODES[role] = len(ROLES) - 1
+    return code
+
+
+class HistoryMessage:
+    """One message of a history: role code, content and its cached token count, never changed once built"""
+
+    __slots__ = ('role_code', 'content', 'tokens')
+
+    def __init__(self, role_code: int, content: str, tokens: int):
+        self.role_code = role_code
+        self.content = content
+        self.tokens = tokens
+
+    @property
+    def role(self) -> str:
+        return ROLES[self.role_code]
+
+    def to_dict(self) -> dict:
+        return {"role": ROLES[self.role_code], "content": self.content}
 
-from telegram import Message
 
 class TelegamUserHistory:
 
-    def __init__(self, user_id: int, user_name: str, logs_folder):
+    # share of the budget the window is refilled to when it has to slide
+    WINDOW_REFILL = 0.5
+    COMPRESS_LEVEL = 6
+
+    def __init__(self, user_id: int, user_name: str, backend: BaseHistoryBackend, storage: list = None, token_counter=None):
         self.user_name = user_name
         self.user_id = user_id
-        self._folder = logs_folder
-        self._user_history_path = f'{self._folder}/{self.user_name}_{self.user_id}.txt'
-        self._storage = self._genStorage()
+        self.last_used = 0.0
+        self._backend = backend
+        self._token_counter = token_counter
+        storage = storage if storage is not None else self._genStorage()
+        self._messages = [self._make_message(entry["role"], entry["content"]) for entry in storage]
+        self._packed = None
+        self._messages_count = len(self._messages)
+        self._tokens_total = sum(message.tokens for message in self._messages)
+        self._pending = []
+        self._rewrite = False
+        self._generation = 0
+        self._window_start = 0
 
-    @staticmethod
-    def get_history(message: Message, logs_folder: str):
-        user_id = message.from_user.id
-        user_name = message.from_user.username
-        return TelegamUserHistory(user_id, user_name, logs_folder)
+    @property
+    def dirty(self) -> bool:
+        return self._rewrite or len(self._pending) > 0
 
-    def get_storage(self):
-        return self._storage
+    @property
+    def tokens_count(self) -> int:
+        """Tokens of the whole history as a chat prompt, kept up to date on every change"""
+        if not self._messages_count:
+            return 0
+        return self._tokens_total + 3
 
-    def _genStorage(self) -> list:
-        try:
-            with open(self._user_history_path, 'r') as file:
-                data = file.read()
-                return json.loads(data)
-        except FileNotFoundError:
+    @property
+    def messages_count(self) -> int:
+        return self._messages_count
+
+    @property
+    def last_tokens(self) -> int:
+        """Tokens of the last message"""
+        messages = self._get_messages()
+        return messages[-1].tokens if messages else 0
+
+    def get_storage(self) -> list:
+        """The whole history as API message dicts, built on every call"""
+        return [message.to_dict() for message in self._get_messages()]
+
+    @property
+    def generation(self) -> int:
+        """Changes every time the history is reset or summarized"""
+        return self._generation
+
+    @property
+    def compressed(self) -> bool:
+        return self._packed is not None
+
+    def pack(self) -> bytes:
+        """The messages zlib-compressed, safe to call from a worker thread"""
+        rows = [[message.role_code, message.content, message.tokens] for message in list(self._messages)]
+        return zlib.compress(json.dumps(rows, ensure_ascii=False).encode(), self.COMPRESS_LEVEL)
+
+    def set_packed(self, packed: bytes, generation: int, messages_count: int) -> bool:
+        """Drop the messages and keep packed instead, unless the history changed since pack() was called"""
+        if self.dirty or self._generation != generation or self._messages_count != messages_count or self._packed is not None:
+            return False
+        self._packed = packed
+        self._messages = None
+        return True
+
+    @property
+    def packed_size(self) -> int:
+        return len(self._packed) if self._packed is not None else 0
+
+    def _get_messages(self) -> list:
+        if self._packed is not None:
+            # a compressed idle history is inflated on its first use
+            rows = json.loads(zlib.decompress(self._packed))
+            self._messages = [HistoryMessage(*row) for row in rows]
+            self._packed = None
+        return self._messages
+
+    def get_window(self, max_tokens: int) -> list:
+        """Return the most recent messages that fit into max_tokens, keeping a leading summary.
+
+        The window start only moves when the messages after it stop fitting, it then skips ahead
+        so the window is refilled to WINDOW_REFILL of the budget. In between consecutive windows
+        only grow at the end, so the provider can serve their common prefix from its prompt cache.
+        Uses the cached token counts, so the cost is O(window) instead of re-encoding the history.
+        """
+        messages = self._get_messages()
+        if not messages:
             return []
+        if self._window_start == 0 and self.tokens_count <= max_tokens:
+            return [message.to_dict() for message in messages]
+        budget = max_tokens - 3
+        head = 1 if messages[0].role_code == ROLE_CODES["system"] and messages[0].tokens < budget else 0
+        if head:
+            budget -= messages[0].tokens
+        start = max(self._window_start, head)
+        if sum(message.tokens for message in messages[start:]) > budget:
+            budget *= self.WINDOW_REFILL
+            start = len(messages)
+            while start > head and messages[start - 1].tokens <= budget:
+                start -= 1
+                budget -= messages[start].tokens
+            start = min(start, len(messages) - 1)
+        self._window_start = start
+        return [message.to_dict() for message in messages[:head] + messages[start:]]
+
+    def replace_prefix(self, count: int, text: str):
+        """Replace the first count messages with a summary, keeping the messages added after them"""
+        tail = self._get_messages()[count:]
+        self._messages = []
+        self._messages_count = 0
+        self._tokens_total = 0
+        self._append(self._make_message("system", text))
+        self._messages.extend(tail)
+        self._messages_count += len(tail)
+        self._tokens_total += sum(message.tokens for message in tail)
+        self._pending = []
+        self._rewrite = True
+        self._generation += 1
+        self._window_start = 0
+
+    def set_token_counter(self, token_counter):
+        self._token_counter = token_counter
+        self._messages = [self._make_message(message.role, message.content) for message in self._get_messages()]
+        self._tokens_total = sum(message.tokens for message in self._messages)
+
+    def _make_message(self, role: str, content: str) -> HistoryMessage:
+        tokens = self._token_counter({"role": role, "content": content}) if self._token_counter is not None else 0
+        return HistoryMessage(role_code(role), content, tokens)
+
+    def _append(self, message: HistoryMessage):
+        self._get_messages().append(message)
+        self._messages_count += 1
+        self._tokens_total += message.tokens
+
+    def _genStorage(self) -> list:
+        return self._backend.load(self.user_id, self.user_name)
+
+    def take_snapshot(self) -> tuple:
+        """Return the changes to persist and mark the history as clean, as messages made into dicts by to_entries"""
+        snapshot = (self._rewrite, self._pending, list(self._get_messages()))
+        self._rewrite = False
+        self._pending = []
+        return snapshot
+
+    def mark_unsaved(self):
+        """A snapshot was not written, the next one rewrites the whole history"""
+        self._rewrite = True
+
+    @staticmethod
+    def to_entries(snapshot: tuple) -> tuple:
+        """(rewrite, pending, storage, tokens) for the backend, can run in a worker thread"""
+        rewrite, pending, messages = snapshot
+        return (rewrite, [message.to_dict() for message in pending],
+                [message.to_dict() for message in messages], [message.tokens for message in messages])
+
+    def write_snapshot(self, snapshot: tuple) -> bool:
+        return not self._backend.write_batch([(self.user_id, self.user_name, *self.to_entries(snapshot))])
 
-    def saveHistory(self):
-        with open(self._user_history_path, 'w') as user_history_file:
-            json.dump(self._storage, user_history_file)
+    def saveHistory(self) -> bool:
+        if self.write_snapshot(self.take_snapshot()):
+            return True
+        self.mark_unsaved()
+        return False
 
-    def add_to_history(self, text: dict, is_bot: bool):
+    def add_to_history(self, text: str, is_bot: bool):
         role = "assistant" if is_bot else "user"
-        self._storage.append({"role": role, "content": text})
-        self.saveHistory()
+        message = self._make_message(role, text)
+        self._append(message)
+        self._pending.append(message)
 
     async def clear_history(self):
-        self._storage = []
-        if await asyncio.to_thread(os.path.exists, self._user_history_path):
-            await asyncio.to_thread(os.remove, self._user_history_path)
+        self._messages = []
+        self._packed = None
+        self._messages_count = 0
+        self._tokens_total = 0
+        self._pending = []
+        self._rewrite = True
+        self._generation += 1
+        self._window_start = 0
 
     async def summary_history(self, text: str):
         await self.clear_history()
-        self._storage.append({"role": "system", "content": text})
-        self.saveHistory()
+        self._append(self._make_message("system", text))
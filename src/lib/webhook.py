@@ -0,0 +1,179 @@
+import asyncio
+import json
+import os
+import signal
+from http import HTTPStatus
+
+import tornado.web
+from tornado.httpserver import HTTPServer
+from tornado.netutil import bind_sockets
+from telegram import Update
+from telegram.ext import Application
+
+from .metrics import REGISTRY
+
+
+class WebhookUpdateHandler(tornado.web.RequestHandler):
+
+    SUPPORTED_METHODS = ("POST",)
+
+    def initialize(self, server):
+        self.server = server
+
+    async def post(self):
+        secret_token = self.server.secret_token
+        if secret_token and self.request.headers.get("X-Telegram-Bot-Api-Secret-Token") != secret_token:
+            raise tornado.web.HTTPError(HTTPStatus.FORBIDDEN)
+        try:
+            update = Update.de_json(json.loads(self.request.body), self.server.application.bot)
+        except Exception as e:
+            print("Error parsing webhook update: ", e)
+            raise tornado.web.HTTPError(HTTPStatus.BAD_REQUEST)
+        if update is not None:
+            await self.server.application.update_queue.put(update)
+        self.set_status(HTTPStatus.OK)
+
+
+class HealthHandler(tornado.web.RequestHandler):
+    """Liveness: the process is up and the event loop answers"""
+
+    SUPPORTED_METHODS = ("GET",)
+
+    def get(self):
+        self.write({"status": "ok"})
+
+
+class ReadinessHandler(tornado.web.RequestHandler):
+    """Readiness: the application accepts updates, turns 503 while draining so the balancer stops routing here"""
+
+    SUPPORTED_METHODS = ("GET",)
+
+    def initialize(self, server):
+        self.server = server
+
+    def get(self):
+        if not self.server.ready:
+            self.set_status(HTTPStatus.SERVICE_UNAVAILABLE)
+            self.write({"status": "draining" if self.server.draining else "starting"})
+            return
+        self.write({"status": "ready"})
+
+
+class MetricsHandler(tornado.web.RequestHandler):
+    """Prometheus text exposition of the process metrics"""
+
+    SUPPORTED_METHODS = ("GET",)
+
+    def get(self):
+        self.set_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.write(REGISTRY.render())
+
+
+class MetricsServer:
+    """Standalone /metrics and /healthz endpoint, for the polling mode or a separate metrics port"""
+
+    def __init__(self, port: int, listen: str = None):
+        self.port = port
+        self.listen = listen or '0.0.0.0'
+        self._http_server = None
+
+    def start(self):
+        app = tornado.web.Application([
+            (r"/metrics", MetricsHandler),
+            (r"/healthz", HealthHandler),
+        ])
+        self._http_server = HTTPServer(app)
+        self._http_server.listen(self.port, address=self.listen)
+        print(f"Metrics server listening on {self.listen}:{self.port}/metrics")
+
+    async def stop(self):
+        if self._http_server is not None:
+            self._http_server.stop()
+            await self._http_server.close_all_connections()
+            self._http_server = None
+
+
+class WebhookServer:
+    """Receives updates over HTTP instead of getUpdates polling.
+
+    Besides the webhook path serves /healthz and /readyz for a load balancer and /metrics
+    for Prometheus. With reuse_port several worker processes can listen on the same port.
+    """
+
+    def __init__(self, application: Application, configuration):
+        self.application = application
+        self.listen = getattr(configuration, 'webhook_listen', None) or '0.0.0.0'
+        self.port = int(getattr(configuration, 'webhook_port', None) or 8080)
+        self.path = '/' + (getattr(configuration, 'webhook_path', None) or 'telegram').strip('/')
+        self.webhook_url = getattr(configuration, 'webhook_url', None)
+        self.secret_token = getattr(configuration, 'webhook_secret_token', None) or os.environ.get("telegram_webhook_secret", None)
+        self.max_connections = int(getattr(configuration, 'webhook_max_connections', None) or 40)
+        self.register = getattr(configuration, 'webhook_register', True) is not False
+        self.reuse_port = bool(getattr(configuration, 'webhook_reuse_port', False))
+        self.drain_timeout = float(getattr(configuration, 'webhook_drain_timeout', None) or 0)
+        self.draining = False
+        self._http_server = None
+        self._stop_event = None
+
+    @property
+    def ready(self) -> bool:
+        return self.application.running and not self.draining
+
+    def make_app(self) -> tornado.web.Application:
+        return tornado.web.Application([
+            (rf"{self.path}/?", WebhookUpdateHandler, {"server": self}),
+            (r"/healthz", HealthHandler),
+            (r"/readyz", ReadinessHandler, {"server": self}),
+            (r"/metrics", MetricsHandler),
+        ])
+
+    def run(self):
+        asyncio.run(self.serve())
+
+    async def serve(self):
+        self._stop_event = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, self._stop_event.set)
+        await self.application.initialize()
+        if self.application.post_init:
+            await self.application.post_init(self.application)
+        await self.application.start()
+        try:
+            if self.register:
+                if not self.webhook_url:
+                    raise ValueError("webhook_url is required to register the webhook")
+                await self.application.bot.set_webhook(
+                    url=self.webhook_url,
+                    secret_token=self.secret_token,
+                    max_connections=self.max_connections,
+                    allowed_updates=Update.ALL_TYPES,
+                )
+            sockets = bind_sockets(self.port, address=self.listen, reuse_port=self.reuse_port)
+            self._http_server = HTTPServer(self.make_app())
+            self._http_server.add_sockets(sockets)
+            print(f"Webhook server listening on {self.listen}:{self.port}{self.path}")
+            await self._stop_event.wait()
+            self.draining = True
+            if self.drain_timeout:
+                # keep accepting updates while the balancer notices /readyz failing
+                await asyncio.sleep(self.drain_timeout)
+        finally:
+            await self.shutdown()
+
+    def stop(self):
+        if self._stop_event is not None:
+            self._stop_event.set()
+
+    async def shutdown(self):
+        self.draining = True
+        if self._http_server is not None:
+            self._http_server.stop()
+            await self._http_server.close_all_connections()
+            self._http_server = None
+        if self.application.running:
+            # stop() processes the updates already in the queue before returning
+            await self.application.stop()
+        if self.application.post_shutdown:
+            await self.application.post_shutdown(self.application)
+        await self.application.shutdown()
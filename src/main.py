@@ -1,18 +1,27 @@
+import time
+
+STARTED = time.perf_counter()
+
 import argparse
 import os
 
 from lib.configuration import YamlConfiguration
-from lib.ai import OpenAI
-from lib.telegram import TelegramBot
+from lib.metrics import StartupTimer
 
 
-def parse_configuration():
-    parser = argparse.ArgumentParser()
+def add_configuration_arguments(parser: argparse.ArgumentParser):
     parser.add_argument('--config', type=str, default='config.yaml')
     parser.add_argument('--path', type=str, default='')
+
+
+def parse_configuration():
+    parser = argparse.ArgumentParser()
+    add_configuration_arguments(parser)
     parser = parser.parse_args()
-    config = parser.config
-    path = parser.path
+    return load_configuration(parser.config, parser.path)
+
+
+def load_configuration(config: str, path: str = ''):
     if path != '':
         config = os.path.join(path, config)
     work_folder = os.path.dirname(os.path.abspath(__file__))
@@ -32,14 +41,33 @@ def parse_configuration():
         if not os.path.exists(logs_dir):
             os.makedirs(logs_dir)
         config.telegram_settings.logs_dir = logs_dir
-    return config
+    return config, file_path, work_folder
 
 
 def main():
-    config = parse_configuration()
+    timer = StartupTimer(STARTED)
+    timer.mark('imports')
+    config, config_file, work_folder = parse_configuration()
+    timer.mark('config')
+    workers = getattr(config.telegram_settings, 'workers', None) or 0
+    if workers > 1:
+        # the front process only routes updates, workers import the AI stack themselves
+        from lib.sharding import ShardedTelegramBot
+        timer.mark('front imports')
+        print(timer.report())
+        ShardedTelegramBot(config, workers, config_file=config_file, work_folder=work_folder).run()
+        return
+    from lib.ai import OpenAI
+    from lib.telegram import TelegramBot
+    timer.mark('bot imports')
     open_ai = OpenAI(configuration=config.ai_settings)
     telegram_app = TelegramBot(configuration=config.telegram_settings)
     telegram_app.set_ai_handler(open_ai)
+    telegram_app.watch_config(config_file, work_folder)
+    timer.mark('init')
+    open_ai.warm_up()
+    timer.mark('warm-up')
+    print(timer.report())
     telegram_app.start_telegram_bot()
 
 if __name__ == '__main__':
@@ -0,0 +1,270 @@
+"""Offline maintenance of the user histories in logs_dir, run it while the bot is stopped.
+
+Every {user}_{id}.txt and .jsonl history is read and token counted with the configured
+model's encoding in a process pool, the results are handled in one streaming pass: size
+and token distributions are reported, histories over --max-tokens are truncated or
+summarized down to --keep-tokens, and histories idle for --archive-idle-days are moved
+to logs_dir/archive as gzip files named by the time of their last change.
+
+    python maintenance.py --oversized summarize --archive-idle-days 90
+    python maintenance.py --oversized truncate --dry-run
+"""
+import argparse
+import asyncio
+import gzip
+import os
+import shutil
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from lib.ai import load_encoding
+from lib.history_backends import JournalHistoryBackend, JsonHistoryBackend, create_history_backend
+from lib.prompt import PromptAssembler
+from lib.telegram_history import TelegamUserHistory
+from main import add_configuration_arguments, load_configuration
+
+HISTORY_BACKENDS = {
+    'txt': JsonHistoryBackend,
+    'jsonl': JournalHistoryBackend,
+}
+ARCHIVE_FOLDER = 'archive'
+
+# token counting state of a pool process, set up once by _init_worker
+_encoding = None
+_tokens_per_message = 0
+_tokens_per_name = 0
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    add_configuration_arguments(parser)
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--max-tokens', type=int, default=None, help='histories over it are oversized, max_tokens by default')
+    parser.add_argument('--keep-tokens', type=int, default=None, help='tokens kept of an oversized history, half of --max-tokens by default')
+    parser.add_argument('--oversized', choices=('report', 'truncate', 'summarize'), default='report')
+    parser.add_argument('--stub-summary', action='store_true', help='summarize locally instead of calling OpenAI')
+    parser.add_argument('--archive-idle-days', type=float, default=None)
+    parser.add_argument('--migrate', action='store_true', help='move .txt histories to the journal or sqlite backend first')
+    parser.add_argument('--dry-run', action='store_true', help='report what would be done without changing files')
+    parser.add_argument('--top', type=int, default=10)
+    return parser.parse_args()
+
+
+def history_files(folder: str):
+    """Paths of the histories in folder, listed lazily"""
+    with os.scandir(folder) as entries:
+        for entry in entries:
+            name, _, ext = entry.name.rpartition('.')
+            if ext not in HISTORY_BACKENDS or not entry.is_file():
+                continue
+            if name.rpartition('_')[2].isdigit():
+                yield entry.path
+
+
+def _init_worker(model: str, tokens_per_message: int, tokens_per_name: int):
+    global _encoding, _tokens_per_message, _tokens_per_name
+    _encoding = load_encoding(model)
+    _tokens_per_message = tokens_per_message
+    _tokens_per_name = tokens_per_name
+
+
+def _count_message(message: dict) -> int:
+    tokens = _tokens_per_message
+    for key, value in message.items():
+        tokens += len(_encoding.encode(value))
+        if key == 'name':
+            tokens += _tokens_per_name
+    return tokens
+
+
+def _find_cut(storage: list, tokens: list, keep_tokens: int) -> tuple:
+    """(head, cut): a leading summary is kept if head, then the most recent messages from cut that fit into keep_tokens"""
+    head = 1 if storage[0]["role"] == "system" and tokens[0] < keep_tokens else 0
+    budget = keep_tokens - (tokens[0] if head else 0)
+    start = len(storage)
+    while start > head and tokens[start - 1] <= budget:
+        start -= 1
+        budget -= tokens[start]
+    return head, min(start, len(storage) - 1)
+
+
+def _archive(path: str, archive_folder: str, mtime: float):
+    """Gzip path into archive_folder, named by its mtime so a user archived again keeps the earlier archives"""
+    stamp = time.strftime('%Y%m%d-%H%M%S', time.gmtime(mtime))
+    target = os.path.join(archive_folder, f'{os.path.basename(path)}.{stamp}.gz')
+    tmp_path = target + '.tmp'
+    with open(path, 'rb') as source, gzip.open(tmp_path, 'wb') as archive:
+        shutil.copyfileobj(source, archive)
+    os.replace(tmp_path, target)
+    os.remove(path)
+
+
+def scan_history(path: str, max_tokens: int, keep_tokens: int, archive_before: float | None, archive_folder: str | None) -> dict:
+    """Read and count one history in a pool process, archives it right away when it is idle"""
+    folder, filename = os.path.split(path)
+    name, _, ext = filename.rpartition('.')
+    user_name, _, user_id = name.rpartition('_')
+    stat = os.stat(path)
+    record = {
+        "path": path, "user_name": user_name, "user_id": int(user_id), "format": ext, "size": stat.st_size,
+        "messages": 0, "tokens": 0, "head": 0, "cut": None, "archived": False, "error": None,
+    }
+    try:
+        storage = HISTORY_BACKENDS[ext](folder).load(int(user_id), user_name)
+    except Exception as e:
+        record["error"] = str(e)
+        return record
+    tokens = [_count_message(message) for message in storage]
+    record["messages"] = len(storage)
+    record["tokens"] = sum(tokens) + 3 if storage else 0
+    if archive_before is not None and stat.st_mtime < archive_before:
+        if archive_folder is not None:
+            _archive(path, archive_folder, stat.st_mtime)
+        record["archived"] = True
+    elif record["tokens"] > max_tokens:
+        record["head"], record["cut"] = _find_cut(storage, tokens, keep_tokens)
+    return record
+
+
+class StubSummarizer:
+    """Local stand-in for the summary request: the start of the conversation transcript"""
+
+    MAX_LENGTH = 700
+
+    async def get_chat_message_response(self, messages: list, user_id: int) -> tuple:
+        transcript = " ".join(message["content"] for message in messages[:-1] if message["role"] != "system")
+        return transcript[:self.MAX_LENGTH], None
+
+
+class HistoryReport:
+
+    PERCENTILES = (0.5, 0.9, 0.99)
+
+    def __init__(self, top: int):
+        self._top = top
+        self._records = []
+        self.counts = {"histories": 0, "oversized": 0, "truncated": 0, "summarized": 0, "archived": 0, "errors": 0}
+
+    def add(self, record: dict):
+        self.counts["histories"] += 1
+        if record["error"] is not None:
+            self.counts["errors"] += 1
+            print(f"Error reading {record['path']}: {record['error']}")
+            return
+        self.counts["archived"] += record["archived"]
+        self.counts["oversized"] += record["cut"] is not None
+        # the records are small, the histories themselves are never kept
+        self._records.append((record["tokens"], record["size"], record["messages"], f"{record['user_name']}_{record['user_id']}"))
+
+    @classmethod
+    def _distribution(cls, values: list) -> str:
+        if not values:
+            return "-"
+        values = sorted(values)
+        parts = [f"total {sum(values)}"]
+        for fraction in cls.PERCENTILES:
+            parts.append(f"p{int(fraction * 100)} {values[min(len(values) - 1, int(fraction * len(values)))]}")
+        parts.append(f"max {values[-1]}")
+        return ", ".join(parts)
+
+    def format(self) -> str:
+        lines = [", ".join(f"{key}: {value}" for key, value in self.counts.items())]
+        lines.append("size bytes: " + self._distribution([record[1] for record in self._records]))
+        lines.append("tokens: " + self._distribution([record[0] for record in self._records]))
+        lines.append("messages: " + self._distribution([record[2] for record in self._records]))
+        if self._records:
+            lines.append("largest by tokens:")
+            for tokens, size, messages, user in sorted(self._records, reverse=True)[:self._top]:
+                lines.append(f"  {user}: {tokens} tokens, {size} bytes, {messages} messages")
+        return "\n".join(lines)
+
+
+async def compact_history(record: dict, mode: str, summarizer, prompts: PromptAssembler):
+    """Truncate or summarize the part of an oversized history before record["cut"]"""
+    backend = HISTORY_BACKENDS[record["format"]](os.path.dirname(record["path"]))
+    history = TelegamUserHistory(record["user_id"], record["user_name"], backend)
+    storage = history.get_storage()
+    count = record["cut"]
+    if mode == 'truncate':
+        backend.replace(record["user_id"], record["user_name"], storage[:record["head"]] + storage[count:])
+        return True
+    response_text, error = await summarizer.get_chat_message_response(prompts.summary(storage[:count]), record["user_id"])
+    if error is not None or not response_text:
+        print(f"Error summarizing history of {record['user_name']}_{record['user_id']}: ", error)
+        return False
+    history.replace_prefix(count, response_text)
+    return history.saveHistory()
+
+
+async def run(args, config):
+    ai_settings = config.ai_settings
+    logs_dir = config.telegram_settings.logs_dir
+    backend_name = getattr(config.telegram_settings, 'history_backend', None) or 'json'
+    if backend_name == 'sqlite':
+        print("Histories are kept in SQLite, only files left in logs_dir are scanned")
+    if args.migrate:
+        if backend_name in ('journal', 'sqlite'):
+            backend = create_history_backend(config.telegram_settings)
+            try:
+                print(f"Migrated {backend.migrate_all()} histories to the {backend_name} backend")
+            finally:
+                backend.close()
+        else:
+            print("--migrate only applies to the journal and sqlite history backends")
+    max_tokens = args.max_tokens or ai_settings.max_tokens
+    keep_tokens = args.keep_tokens or max_tokens // 2
+    archive_before = None
+    archive_folder = None
+    if args.archive_idle_days is not None:
+        archive_before = time.time() - args.archive_idle_days * 86400
+        if not args.dry_run:
+            archive_folder = os.path.join(logs_dir, ARCHIVE_FOLDER)
+            os.makedirs(archive_folder, exist_ok=True)
+    mode = None if args.dry_run or args.oversized == 'report' else args.oversized
+    summarizer = None
+    prompts = PromptAssembler(getattr(ai_settings, 'system_prompt', None))
+    if mode == 'summarize':
+        if args.stub_summary:
+            summarizer = StubSummarizer()
+        else:
+            from lib.ai import OpenAI
+            summarizer = OpenAI(configuration=ai_settings)
+    tiktoken_cache_dir = getattr(ai_settings, 'tiktoken_cache_dir', None)
+    if tiktoken_cache_dir:
+        os.environ['TIKTOKEN_CACHE_DIR'] = tiktoken_cache_dir
+
+    report = HistoryReport(args.top)
+    workers = max(1, args.workers or 1)
+    loop = asyncio.get_running_loop()
+    initargs = (ai_settings.chat_model_name, ai_settings.tokens_per_message, ai_settings.tokens_per_name)
+    with ProcessPoolExecutor(workers, initializer=_init_worker, initargs=initargs) as pool:
+        paths = history_files(logs_dir)
+        pending = deque()
+        while True:
+            # a bounded number of scans in flight keeps the memory flat for any number of histories
+            while len(pending) < workers * 4:
+                path = next(paths, None)
+                if path is None:
+                    break
+                pending.append(loop.run_in_executor(pool, scan_history, path, max_tokens, keep_tokens, archive_before, archive_folder))
+            if not pending:
+                break
+            record = await pending.popleft()
+            report.add(record)
+            if record["cut"] is not None and mode is not None:
+                if await compact_history(record, mode, summarizer, prompts):
+                    report.counts["truncated" if mode == 'truncate' else "summarized"] += 1
+    if args.dry_run:
+        print("Dry run, no files were changed")
+    print(report.format())
+
+
+def main():
+    args = parse_args()
+    config, _, _ = load_configuration(args.config, args.path)
+    asyncio.run(run(args, config))
+
+
+if __name__ == '__main__':
+    main()